@@ -0,0 +1,47 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+"""Microbenchmark for accessing the current plugin.
+
+Run it with ``python benchmarks/bench_current_plugin.py``.
+"""
+
+import timeit
+
+from flask_pluginengine import Plugin, current_plugin, get_current_plugin
+from flask_pluginengine.testing import create_plugin_app
+
+
+class BenchmarkPlugin(Plugin):
+    """Benchmark plugin"""
+
+
+def main():
+    app = create_plugin_app(__name__, {'benchmark': BenchmarkPlugin})
+    plugin = app.extensions['pluginengine'].plugins['benchmark']
+    number = 1_000_000
+    cases = {
+        'bool(current_plugin)': lambda: bool(current_plugin),
+        'current_plugin.name': lambda: current_plugin.name,
+        'get_current_plugin()': lambda: get_current_plugin(),
+        'get_current_plugin().name': lambda: get_current_plugin().name,
+    }
+    with app.app_context():
+        print('no plugin context:')
+        _run({name: func for name, func in cases.items() if not name.endswith('.name')}, number)
+        with plugin.plugin_context():
+            print('plugin context:')
+            _run(cases, number)
+
+
+def _run(cases, number):
+    for name, func in cases.items():
+        elapsed = min(timeit.repeat(func, number=number, repeat=5))
+        print(f'  {name:<28} {elapsed / number * 1e9:8.1f} ns')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+"""Benchmark for the time it takes to import Flask-PluginEngine.
+
+Run it with ``python benchmarks/bench_import.py``.  Every case runs in
+a fresh interpreter, using ``python -X importtime`` to measure only the
+time spent importing modules.
+"""
+
+import re
+import subprocess
+import sys
+
+
+CASES = {
+    'import flask': 'import flask',
+    'import flask_pluginengine': 'import flask_pluginengine',
+    'current_plugin': 'from flask_pluginengine import current_plugin',
+    'Plugin': 'from flask_pluginengine import Plugin',
+    'PluginEngine': 'from flask_pluginengine import PluginEngine',
+    'everything': 'from flask_pluginengine import *',
+}
+
+
+def measure(code):
+    """Get the total import time (in seconds) and the imported package modules."""
+    script = f'{code}\nimport sys\nprint(" ".join(m for m in sys.modules if m.startswith("flask_pluginengine.")))'
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], capture_output=True, text=True,
+                          check=True)
+    # the cumulative time of top-level imports (no indentation before the module name)
+    total = sum(int(m.group(1)) for m in re.finditer(r'^import time:\s+\d+ \|\s+(\d+) \| \S', proc.stderr, re.M))
+    return total / 1e6, proc.stdout.split()
+
+
+def main(repeat=5):
+    for name, code in CASES.items():
+        results = [measure(code) for _ in range(repeat)]
+        elapsed = min(total for total, __ in results)
+        modules = ', '.join(sorted(m.split('.', 1)[1] for m in results[0][1])) or '-'
+        print(f'{name:<26} {elapsed * 1000:7.1f} ms  ({modules})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+"""Benchmark for rendering templates with many output chunks.
+
+Every block and root render function of a template is wrapped so it runs
+in the correct plugin context, so this measures the overhead of those
+wrappers compared to a plain Flask application.
+
+Run it with ``python benchmarks/bench_render.py``.
+"""
+
+import timeit
+
+from flask import Flask, render_template
+from jinja2 import DictLoader
+
+from flask_pluginengine import Plugin, PluginFlask, render_plugin_template
+from flask_pluginengine.templating import PluginPrefixLoader
+from flask_pluginengine.testing import create_plugin_app
+
+
+ITEMS = 2000
+
+TEMPLATES = {
+    'base.txt': '{% block content %}{% for i in items %}{{ i }},{% endfor %}{% endblock %}',
+    'child.txt': "{% extends 'base.txt' %}{% block content %}{{ super() }}{% endblock %}",
+}
+
+
+class BenchmarkPlugin(Plugin):
+    """Benchmark plugin"""
+
+
+class DictPluginLoader(PluginPrefixLoader):
+    # load plugin templates from memory instead of the plugin's folder
+    def get_loader(self, template):
+        return DictLoader({f'benchmark:{name}': source for name, source in TEMPLATES.items()}), template
+
+
+class BenchmarkFlask(PluginFlask):
+    plugin_jinja_loader = DictPluginLoader
+
+
+def main():
+    items = list(range(ITEMS))
+    flask_app = Flask(__name__)
+    flask_app.jinja_loader = DictLoader(TEMPLATES)
+    plugin_app = create_plugin_app(__name__, {'benchmark': BenchmarkPlugin}, app_class=BenchmarkFlask)
+    plugin_app.jinja_loader = DictLoader(TEMPLATES)
+    plugin = plugin_app.extensions['pluginengine'].plugins['benchmark']
+    print(f'{ITEMS} items:')
+    with flask_app.app_context():
+        _run('flask, core template', lambda: render_template('child.txt', items=items))
+    with plugin_app.app_context():
+        _run('plugins, core template', lambda: render_template('child.txt', items=items))
+        with plugin.plugin_context():
+            _run('plugins, plugin template', lambda: render_plugin_template('child.txt', items=items))
+
+
+def _run(name, func, number=500):
+    func()
+    elapsed = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f'  {name:<28} {elapsed * 1000:7.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+"""Benchmark for registering the URL rules of plugin blueprints.
+
+Run it with ``python benchmarks/bench_route_registration.py``.
+"""
+
+import time
+
+from werkzeug.routing import Rule
+
+from flask_pluginengine import Plugin, PluginBlueprint, PluginFlask
+from flask_pluginengine.testing import create_plugin_app
+
+
+PLUGINS = 10
+BLUEPRINTS = 5
+RULES = 50
+
+
+class RoutesPlugin(Plugin):
+    """Plugin with many routes"""
+
+    def init(self):
+        for i in range(BLUEPRINTS):
+            blueprint = PluginBlueprint(f'{self.name}_{i}', __name__)
+            for j in range(RULES):
+                blueprint.add_url_rule(f'/{self.name}/{i}/rule{j}/<int:id>', f'rule{j}', _view)
+            self.app.register_blueprint(blueprint)
+
+
+def _view(id):
+    return str(id)
+
+
+class EagerRuleFlask(PluginFlask):
+    plugin_url_rule_class = Rule
+
+
+def main(repeat=3):
+    plugins = {f'plugin{i}': type(f'RoutesPlugin{i}', (RoutesPlugin,), {'__doc__': 'Routes'})
+               for i in range(PLUGINS)}
+    print(f'{PLUGINS * BLUEPRINTS * RULES} rules')
+    for name, app_class in (('werkzeug rules', EagerRuleFlask), ('lazy builder rules', PluginFlask)):
+        elapsed = min(_measure(plugins, app_class) for _ in range(repeat))
+        print(f'  {name:<20} {elapsed * 1000:8.1f} ms')
+
+
+def _measure(plugins, app_class):
+    start = time.perf_counter()
+    app = create_plugin_app(__name__, plugins, app_class=app_class)
+    with app.test_request_context():
+        pass
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
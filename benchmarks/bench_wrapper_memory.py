@@ -0,0 +1,68 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+"""Memory benchmark for functions wrapped in a plugin context.
+
+Run it with ``python benchmarks/bench_wrapper_memory.py``.
+"""
+
+import tracemalloc
+from functools import wraps
+
+from flask_pluginengine import Plugin
+from flask_pluginengine.testing import create_plugin_app
+from flask_pluginengine.util import wrap_in_plugin_context
+
+
+class BenchmarkPlugin(Plugin):
+    """Benchmark plugin"""
+
+
+def _closure_wrapper(plugin, func):
+    # how functions used to be wrapped
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        with plugin.plugin_context():
+            return func(*args, **kwargs)
+
+    return wrapped
+
+
+def _make_funcs(count):
+    funcs = []
+    for i in range(count):
+        def func():
+            pass
+        func.__name__ = func.__qualname__ = f'func_{i}'
+        funcs.append(func)
+    return funcs
+
+
+def _measure(wrap, funcs):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        wrappers = [wrap(func) for func in funcs]
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del wrappers
+    return size / len(funcs)
+
+
+def main():
+    app = create_plugin_app(__name__, {'benchmark': BenchmarkPlugin})
+    plugin = app.extensions['pluginengine'].plugins['benchmark']
+    count = 10_000
+    closure_size = _measure(lambda func: _closure_wrapper(plugin, func), _make_funcs(count))
+    # bypass the memoization so only the wrapper itself is measured
+    slotted_size = _measure(lambda func: wrap_in_plugin_context.__wrapped__(plugin, func), _make_funcs(count))
+    print(f'{"closure":>10}: {closure_size:7.1f} bytes/wrapper')
+    print(f'{"slotted":>10}: {slotted_size:7.1f} bytes/wrapper')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,18 +4,67 @@
 # Flask-PluginEngine is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
-from .engine import PluginEngine
-from .globals import current_plugin
-from .mixins import (PluginBlueprint, PluginBlueprintMixin, PluginBlueprintSetupState, PluginBlueprintSetupStateMixin,
-                     PluginFlask, PluginFlaskMixin)
-from .plugin import Plugin, depends, render_plugin_template, url_for_plugin, uses
-from .signals import plugins_loaded
-from .templating import PluginPrefixLoader
-from .util import plugin_context, trim_docstring, with_plugin_context, wrap_in_plugin_context
+import sys
+from importlib import import_module
 
 
 __version__ = '0.5'
-__all__ = ('PluginEngine', 'current_plugin', 'PluginBlueprintSetupState', 'PluginBlueprintSetupStateMixin',
-           'PluginBlueprint', 'PluginBlueprintMixin', 'PluginFlask', 'PluginFlaskMixin', 'Plugin', 'uses', 'depends',
-           'render_plugin_template', 'url_for_plugin', 'plugins_loaded', 'PluginPrefixLoader', 'with_plugin_context',
-           'wrap_in_plugin_context', 'trim_docstring', 'plugin_context')
+__all__ = ('PluginEngine', 'current_plugin', 'get_current_plugin', 'PluginBlueprintSetupState',
+           'PluginBlueprintSetupStateMixin', 'PluginBlueprint', 'PluginBlueprintMixin', 'PluginFlask',
+           'PluginFlaskMixin', 'Plugin', 'uses', 'depends', 'render_plugin_template', 'url_for_plugin',
+           'plugins_loaded', 'PluginPrefixLoader', 'with_plugin_context', 'wrap_in_plugin_context', 'trim_docstring',
+           'plugin_context', 'PluginRegistry', 'hook', 'stream_plugin_template', 'url_for_plugin_static')
+
+# The submodules are only imported when one of their attributes is accessed,
+# so e.g. using `current_plugin` does not import the engine or the templating
+# code (PEP 562).
+_lazy_attributes = {
+    'PluginEngine': 'engine',
+    'current_plugin': 'globals',
+    'get_current_plugin': 'globals',
+    'PluginBlueprint': 'mixins',
+    'PluginBlueprintMixin': 'mixins',
+    'PluginBlueprintSetupState': 'mixins',
+    'PluginBlueprintSetupStateMixin': 'mixins',
+    'PluginFlask': 'mixins',
+    'PluginFlaskMixin': 'mixins',
+    'Plugin': 'plugin',
+    'depends': 'plugin',
+    'hook': 'plugin',
+    'render_plugin_template': 'plugin',
+    'stream_plugin_template': 'plugin',
+    'url_for_plugin': 'plugin',
+    'url_for_plugin_static': 'plugin',
+    'uses': 'plugin',
+    'PluginRegistry': 'registry',
+    'plugins_loaded': 'signals',
+    'PluginPrefixLoader': 'templating',
+    'plugin_context': 'util',
+    'trim_docstring': 'util',
+    'with_plugin_context': 'util',
+    'wrap_in_plugin_context': 'util',
+}
+
+# submodules which are imported when accessed as attributes of the package,
+# like they were when the package imported them eagerly
+_lazy_submodules = frozenset(('audit', 'budgets', 'caching', 'cli', 'engine', 'globals', 'graph', 'memory', 'mixins',
+                              'plugin', 'profiler', 'registry', 'signals', 'templating', 'testing', 'util'))
+
+
+def __getattr__(name):
+    if name in _lazy_submodules:
+        # importing a submodule sets it as an attribute of the package
+        return import_module(f'.{name}', __name__)
+    try:
+        module_name = _lazy_attributes[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    value = getattr(import_module(f'.{module_name}', __name__), name)
+    # cache it so __getattr__ is not used again for this name; note that we
+    # cannot use `globals()` here since the `globals` submodule shadows it
+    setattr(sys.modules[__name__], name, value)
+    return value
+
+
+def __dir__():
+    return sorted(set(vars(sys.modules[__name__])) | set(__all__))
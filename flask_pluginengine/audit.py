@@ -0,0 +1,147 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
+from importlib.abc import MetaPathFinder
+
+
+class ModuleImport(namedtuple('ModuleImport', ('name', 'self_time', 'cumulative_time', 'memory'))):
+    """Information about a module imported while loading a plugin.
+
+    :param name: The name of the module
+    :param self_time: The time in seconds spent executing the module itself
+    :param cumulative_time: The time in seconds spent executing the module
+                            including the modules it imported
+    :param memory: The approximate number of bytes allocated while
+                   executing the module (including the modules it imported)
+    """
+
+    __slots__ = ()
+
+
+class PluginImportReport(namedtuple('PluginImportReport', ('plugin', 'modules', 'elapsed', 'memory'))):
+    """Information about the modules imported while loading a plugin.
+
+    :param plugin: The name of the plugin
+    :param modules: A tuple of :class:`ModuleImport` objects in the
+                    order in which the modules finished loading. Timings
+                    are ``None`` for modules which were not imported
+                    using the regular import system.
+    :param elapsed: The time in seconds spent loading the plugin
+    :param memory: The approximate number of bytes allocated while
+                   loading the plugin
+    """
+
+    __slots__ = ()
+
+    def to_dict(self):
+        """Convert the report to a JSON-serializable dict."""
+        return {'plugin': self.plugin, 'elapsed': self.elapsed, 'memory': self.memory,
+                'modules': [module._asdict() for module in self.modules]}
+
+
+class _TimingLoader:
+    """Loader wrapper recording how long it takes to execute a module."""
+
+    def __init__(self, audit, loader):
+        self._audit = audit
+        self._loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        try:
+            with self._audit._time_module(module.__name__):
+                self._loader.exec_module(module)
+        finally:
+            # do not leave our wrapper around after the import
+            module.__loader__ = self._loader
+            if module.__spec__ is not None:
+                module.__spec__.loader = self._loader
+
+
+class _TimingFinder(MetaPathFinder):
+    """Finder wrapping the loaders of all other finders."""
+
+    def __init__(self, audit):
+        self._audit = audit
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                spec.loader = _TimingLoader(self._audit, spec.loader)
+            return spec
+        return None
+
+
+class ImportAudit:
+    """Record the modules imported inside a ``with`` block.
+
+    Similar to ``python -X importtime``, the time spent importing each
+    module is recorded.  Memory usage is measured using :mod:`tracemalloc`,
+    which is started temporarily if it is not tracing yet.
+
+    Imports from other threads are recorded as well while the audit is
+    active.
+
+    :param plugin: The name of the plugin being loaded
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.report = None
+        self._finder = _TimingFinder(self)
+        self._timings = {}
+        self._stack = []
+
+    def _get_memory(self):
+        return tracemalloc.get_traced_memory()[0]
+
+    @contextmanager
+    def _time_module(self, name):
+        self._stack.append([time.perf_counter(), self._get_memory(), 0])
+        try:
+            yield
+        finally:
+            start, start_memory, children = self._stack.pop()
+            cumulative = time.perf_counter() - start
+            if self._stack:
+                self._stack[-1][2] += cumulative
+            self._timings[name] = (cumulative - children, cumulative, self._get_memory() - start_memory)
+
+    def __enter__(self):
+        self._stop_tracemalloc = not tracemalloc.is_tracing()
+        if self._stop_tracemalloc:
+            tracemalloc.start()
+        self._modules_before = set(sys.modules)
+        self._start_memory = self._get_memory()
+        self._start = time.perf_counter()
+        sys.meta_path.insert(0, self._finder)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        sys.meta_path.remove(self._finder)
+        elapsed = time.perf_counter() - self._start
+        memory = self._get_memory() - self._start_memory
+        if self._stop_tracemalloc:
+            tracemalloc.stop()
+        new_modules = [name for name in self._timings if name in sys.modules and name not in self._modules_before]
+        new_modules += sorted(set(sys.modules) - self._modules_before - set(new_modules))
+        modules = tuple(ModuleImport(name, *self._timings.get(name, (None, None, None))) for name in new_modules)
+        self.report = PluginImportReport(self.plugin, modules, elapsed, memory)
@@ -0,0 +1,101 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import time
+import tracemalloc
+from collections import namedtuple
+
+from flask import g, has_app_context
+
+
+class PluginBudget(namedtuple('PluginBudget', ('time', 'memory', 'max_violations'))):
+    """Resource limits for calls running in the context of a plugin.
+
+    Budgets apply to view functions, signal receivers and hooks of a
+    plugin.  Calls are never interrupted; exceeding a budget is logged
+    and counted (see :meth:`~flask_pluginengine.PluginEngine.get_budget_violations`).
+
+    :param time: The maximum wall time per call in seconds
+    :param memory: The maximum number of bytes a call may allocate (and
+                   not free again).  This is only measured while
+                   :mod:`tracemalloc` is tracing memory allocations.
+                   Since :mod:`tracemalloc` only knows the memory used by
+                   the whole process, allocations of other threads are
+                   counted as well, so memory budgets are only meaningful
+                   if requests are handled by a single thread.
+    :param max_violations: The number of time budget violations after which
+                           the signal receivers and hooks of the plugin are
+                           skipped for the rest of the current request.
+                           Memory budget violations are only logged and
+                           counted since they may be caused by other threads.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, time=None, memory=None, max_violations=None):
+        return super().__new__(cls, time, memory, max_violations)
+
+
+def _get_request_violations():
+    if not has_app_context():
+        return None
+    try:
+        return g._pluginengine_budget_violations
+    except AttributeError:
+        rv = g._pluginengine_budget_violations = {}
+        return rv
+
+
+def is_disabled_for_request(plugin):
+    """Check if a plugin exceeded its budget too often in the current request."""
+    if plugin.budget is None or plugin.budget.max_violations is None:
+        return False
+    violations = _get_request_violations()
+    return violations is not None and violations.get(plugin.name, 0) >= plugin.budget.max_violations
+
+
+def _record_violation(plugin, func, kind, value, limit, disable=True):
+    state = plugin.app.extensions['pluginengine']
+    state.record_budget_violation(plugin.name, kind)
+    state.logger.warning('Plugin %s exceeded its %s budget in %s (%s > %s)', plugin.name, kind,
+                         getattr(func, '__qualname__', func), value, limit)
+    if not disable:
+        return
+    violations = _get_request_violations()
+    if violations is not None:
+        violations[plugin.name] = violations.get(plugin.name, 0) + 1
+
+
+def call_with_budget(plugin, func, args, kwargs, skippable=False):
+    """Call a function in a plugin context while enforcing the plugin's budget.
+
+    :param plugin: A plugin instance with a :class:`PluginBudget`
+    :param func: The function to call
+    :param args: Positional arguments for the function
+    :param kwargs: Keyword arguments for the function
+    :param skippable: Whether the call may be skipped if the plugin
+                      has been disabled for the current request
+    """
+    budget = plugin.budget
+    if skippable and is_disabled_for_request(plugin):
+        return None
+    measure_memory = budget.memory is not None and tracemalloc.is_tracing()
+    if measure_memory:
+        start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        with plugin.plugin_context():
+            return func(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        if budget.time is not None and elapsed > budget.time:
+            _record_violation(plugin, func, 'time', f'{elapsed:.3f}s', f'{budget.time}s')
+        if measure_memory:
+            allocated = tracemalloc.get_traced_memory()[0] - start_memory
+            if allocated > budget.memory:
+                # allocations of other threads are included as well, so a violation
+                # never results in the plugin being skipped
+                _record_violation(plugin, func, 'memory', f'{allocated}B', f'{budget.memory}B', disable=False)
@@ -0,0 +1,166 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from .util import get_state, make_hashable, plugin_name_from_template_name
+
+
+class FragmentCache(ABC):
+    """Base class for template fragment cache backends.
+
+    Keys are tuples which may be used as dict keys; backends storing
+    fragments outside the process need to serialize them (e.g. using
+    :func:`repr`).
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """Get a cached fragment.
+
+        :return: The cached fragment or ``None`` if it is not cached
+        """
+
+    @abstractmethod
+    def set(self, key, value):
+        """Cache a fragment."""
+
+    @abstractmethod
+    def clear(self):
+        """Remove all cached fragments."""
+
+
+class LRUFragmentCache(FragmentCache):
+    """In-process fragment cache keeping the most recently used fragments.
+
+    :param maxsize: The maximum number of cached fragments
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f'<LRUFragmentCache({len(self)}/{self.maxsize})>'
+
+
+def get_fragment_cache(app):
+    """Get the fragment cache of an application.
+
+    The cache is configured using ``PLUGINENGINE_FRAGMENT_CACHE``, which
+    can be set to ``True`` to use a :class:`LRUFragmentCache` or to a
+    :class:`FragmentCache` instance.
+
+    :return: A :class:`FragmentCache` or ``None`` if caching is disabled
+    """
+    return get_state(app).fragment_cache
+
+
+class FragmentCacheExtension(Extension):
+    """Jinja extension adding a ``{% cache %}`` tag for template fragments.
+
+    The first argument of the tag is the name of the fragment, any other
+    arguments are values the fragment depends on::
+
+        {% cache 'sidebar', user.id %}
+            {{ render_sidebar(user) }}
+        {% endcache %}
+
+    Cached fragments are keyed by the plugin containing the template, its
+    version, the template name and source, the fragment name and the
+    values it depends on.  This way fragments are automatically invalidated
+    when the template or the version of the plugin changes.  When plugins
+    are (re)loaded, the whole cache of the application is cleared.
+
+    The content of the tag is rendered in the context of the plugin
+    containing the template, just like macro callers.  If fragment caching
+    is not enabled (see :func:`get_fragment_cache`), it is simply rendered
+    each time.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        self._checksums = {}
+
+    def preprocess(self, source, name, filename=None):
+        # remember the source so changes to a template invalidate its fragments
+        # even if the plugin version stays the same
+        if name is not None:
+            self._checksums[name] = hashlib.sha1(source.encode()).hexdigest()
+        return source
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        template_args = [nodes.Const(parser.name), nodes.Const(self._checksums.get(parser.name))]
+        method = '_render_fragment_async' if self.environment.is_async else '_render_fragment'
+        call = self.call_method(method, template_args + [args[0], nodes.List(args[1:])])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _get_cache_key(self, template_name, checksum, fragment_name, vary_keys):
+        plugin_name = plugin_name_from_template_name(template_name)
+        plugin_version = None
+        if plugin_name is not None:
+            plugin = get_state(current_app).plugin_engine.get_plugin(plugin_name)
+            plugin_version = plugin.version if plugin is not None else None
+        return (plugin_name, plugin_version, template_name, checksum, fragment_name, make_hashable(vary_keys))
+
+    def _render_fragment(self, template_name, checksum, fragment_name, vary_keys, caller):
+        cache = get_fragment_cache(current_app)
+        if cache is None:
+            return caller()
+        key = self._get_cache_key(template_name, checksum, fragment_name, vary_keys)
+        rv = cache.get(key)
+        if rv is None:
+            rv = caller()
+            cache.set(key, rv)
+        return rv
+
+    async def _render_fragment_async(self, template_name, checksum, fragment_name, vary_keys, caller):
+        cache = get_fragment_cache(current_app)
+        if cache is None:
+            return await caller()
+        key = self._get_cache_key(template_name, checksum, fragment_name, vary_keys)
+        rv = cache.get(key)
+        if rv is None:
+            rv = await caller()
+            cache.set(key, rv)
+        return rv
@@ -0,0 +1,59 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import json
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from .util import get_state
+
+
+cli = AppGroup('pluginengine', help='Inspect the plugins of the application.')
+
+
+def _format_size(value):
+    if value is None:
+        return '-'
+    return f'{value / 1024:.1f} KiB'
+
+
+@cli.command('memory')
+@click.option('--estimate', is_flag=True, help='Also estimate the size of the objects reachable from each plugin.')
+@click.option('--json', 'as_json', is_flag=True, help='Output the data as JSON.')
+def memory_command(estimate, as_json):
+    """Show the memory used by each plugin.
+
+    The memory allocated while loading the plugins is only available if
+    PLUGINENGINE_TRACK_MEMORY is enabled.
+    """
+    engine = get_state(current_app).plugin_engine
+    report = engine.get_memory_report()
+    rows = []
+    for plugin in engine.iter_active_plugins():
+        usage = report.get(plugin.name)
+        row = {
+            'name': plugin.name,
+            'import': usage.import_memory if usage else None,
+            'init': usage.init_memory if usage else None,
+            'total': usage.total if usage else None,
+        }
+        if estimate:
+            row['size'] = engine.estimate_plugin_size(plugin.name)
+        rows.append(row)
+    rows.sort(key=lambda row: (-(row['total'] or 0), row['name']))
+    if as_json:
+        click.echo(json.dumps(rows, indent=2))
+        return
+    if not report:
+        click.secho('Memory tracking is disabled; enable PLUGINENGINE_TRACK_MEMORY to track allocations.',
+                    fg='yellow', err=True)
+    columns = ['name', 'import', 'init', 'total'] + (['size'] if estimate else [])
+    table = [columns] + [[row['name']] + [_format_size(row[col]) for col in columns[1:]] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    for line in table:
+        click.echo('  '.join([line[0].ljust(widths[0])] + [val.rjust(w) for val, w in zip(line[1:], widths[1:])]))
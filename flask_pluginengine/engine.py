@@ -4,51 +4,167 @@
 # Flask-PluginEngine is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
 from flask import current_app
-from flask.helpers import get_root_path
-from importlib_metadata import entry_points as importlib_entry_points
 from werkzeug.datastructures import ImmutableDict
 
-from .plugin import Plugin
+from .audit import ImportAudit
+from .caching import LRUFragmentCache
+from .cli import cli
+from .graph import DependencyGraph
+from .memory import PluginMemoryUsage, estimate_size, get_traced_memory, tracing_memory
+from .plugin import Plugin, get_hook_methods
+from .profiler import PluginProfiler
+from .registry import PluginLoadError, PluginRegistry
 from .signals import plugins_loaded
-from .util import get_state, resolve_dependencies
+from .util import find_unresolvable_plugins, get_state, resolve_dependency_levels, wrap_in_plugin_context
+
+
+class PluginLoadFailure(namedtuple('PluginLoadFailure', ('name', 'phase', 'message', 'exception', 'elapsed'))):
+    """Information about a plugin which could not be loaded.
+
+    :param name: The name of the plugin
+    :param phase: The phase in which loading the plugin failed: ``lookup``
+                  (no such entry point), ``non-unique`` (multiple entry
+                  points), ``import`` (importing the plugin failed),
+                  ``subclass`` (not a plugin class), ``dependency``
+                  (a hard dependency could not be loaded) or ``init``
+                  (initializing the plugin failed)
+    :param message: A human-readable description of the failure
+    :param exception: The exception that caused the failure, if any
+    :param elapsed: The time in seconds spent on the plugin before it
+                    was considered failed
+    """
+
+    __slots__ = ()
 
 
 class PluginEngine:
     plugin_class = Plugin
 
-    def __init__(self, app=None, **kwargs):
+    def __init__(self, app=None, registry=None, **kwargs):
         self.logger = None
+        #: The :class:`~flask_pluginengine.registry.PluginRegistry` shared
+        #: by all apps using this engine. If not set, plugins are resolved
+        #: from scratch each time they are loaded (but their entry points
+        #: are only looked up once per process in any case, see
+        #: :func:`~flask_pluginengine.registry.clear_entry_point_cache`).
+        self.registry = registry
+        #: The :class:`~flask_pluginengine.profiler.PluginProfiler` started
+        #: using :meth:`start_profiler`.
+        self.profiler = None
         if app is not None:
             self.init_app(app, **kwargs)
 
     def init_app(self, app, logger=None):
         app.extensions['pluginengine'] = _PluginEngineState(self, app, logger or app.logger)
+        app.cli.add_command(cli)
         app.config.setdefault('PLUGINENGINE_PLUGINS', {})
         if not app.config.get('PLUGINENGINE_NAMESPACE'):
             raise Exception('PLUGINENGINE_NAMESPACE is not set')
 
-    def load_plugins(self, app, skip_failed=True):
+    def load_plugins(self, app, skip_failed=True, parallel=False):
         """Load all plugins for an application.
 
         :param app: A Flask application
         :param skip_failed: If True, initialize plugins even if some
                             plugins could not be loaded.
+        :param parallel: If True, initialize plugins which do not depend
+                         on each other in parallel threads. An integer
+                         can be used to limit the number of threads.
+                         This is only useful if the plugins perform slow
+                         I/O during initialization.  Note that the
+                         :meth:`~flask_pluginengine.Plugin.init` methods
+                         of those plugins then run concurrently on the
+                         same application, and Flask does not guarantee
+                         that setting up an application (e.g. registering
+                         blueprints, adding template globals or connecting
+                         signals) is thread-safe.  Only use this if the
+                         plugins do not modify the application during
+                         initialization or protect it with a lock.
         :return: True if all plugins could have been loaded, False otherwise.
+                 If initializing a plugin fails, the exception is re-raised
+                 after recording the failure (see :meth:`get_failure_report`).
         """
         state = get_state(app)
         if state.plugins_loaded:
             raise RuntimeError(f'Plugins already loaded for {state.app}')
         state.plugins_loaded = True
-        plugins = self._import_plugins(state.app)
+        with tracing_memory(app.config.get('PLUGINENGINE_TRACK_MEMORY')):
+            plugins = self._import_plugins(state.app)
+            return self._load_plugin_classes(state, plugins, skip_failed, parallel)
+
+    def _load_plugin_classes(self, state, plugins, skip_failed, parallel):
+        """Initialize already imported plugins for an application.
+
+        :param state: The plugin engine state of the application
+        :param plugins: A dict mapping plugin names to plugin classes
+        :return: True if all plugins could have been loaded, False otherwise.
+        """
+        self._skip_unresolvable(state, plugins)
         if state.failed and not skip_failed:
             return False
-        for name, cls in resolve_dependencies(plugins):
-            instance = cls(self, state.app)
-            state.plugins[name] = instance
-        plugins_loaded.send(app)
+        levels = list(resolve_dependency_levels(plugins))
+        try:
+            with tracing_memory(state.app.config.get('PLUGINENGINE_TRACK_MEMORY')):
+                if parallel:
+                    self._init_plugins_parallel(state, levels, None if parallel is True else parallel)
+                else:
+                    for level in levels:
+                        for name, cls in level:
+                            state.plugins[name] = self._init_plugin(state, name, cls)
+        finally:
+            state.plugins_changed()
+        state.dependency_graph = DependencyGraph(plugins, [[name for name, cls in level] for level in levels])
+        plugins_loaded.send(state.app)
         return not state.failed
 
+    def _init_plugins_parallel(self, state, levels, max_workers):
+        """Initialize plugins in parallel, one dependency level at a time.
+
+        Each plugin is initialized in a worker thread with its own
+        application and plugin context. If any plugin in a level fails
+        to initialize, all errors from that level are logged and recorded
+        as failures, and the first one is re-raised.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pluginengine') as executor:
+            for level in levels:
+                futures = [(name, executor.submit(self._init_plugin, state, name, cls)) for name, cls in level]
+                errors = []
+                for name, future in futures:
+                    try:
+                        state.plugins[name] = future.result()
+                    except Exception as exc:
+                        state.logger.error('Could not initialize plugin %s', name, exc_info=exc)
+                        errors.append(exc)
+                if errors:
+                    raise errors[0]
+
+    def _init_plugin(self, state, name, cls):
+        """Create the instance of a plugin.
+
+        :param state: The plugin engine state of the application
+        :param name: The name of the plugin
+        :param cls: The plugin class
+        :return: The plugin instance
+        """
+        track_memory = state.app.config.get('PLUGINENGINE_TRACK_MEMORY')
+        memory = get_traced_memory() if track_memory else None
+        start = time.perf_counter()
+        try:
+            return cls(self, state.app)
+        except Exception as exc:
+            state.add_failure(name, 'init', 'Could not initialize plugin', exc, start=start)
+            raise
+        finally:
+            if track_memory:
+                state.init_memory[name] = get_traced_memory() - memory
+
     def _import_plugins(self, app):
         """Import the plugins for an application.
 
@@ -56,45 +172,124 @@ class PluginEngine:
         :return: A dict mapping plugin names to plugin classes
         """
         state = get_state(app)
+        registry = self.registry if self.registry is not None else PluginRegistry()
+        audit_imports = app.config.get('PLUGINENGINE_AUDIT_IMPORTS')
+        track_memory = app.config.get('PLUGINENGINE_TRACK_MEMORY')
         plugins = {}
         for name in state.app.config['PLUGINENGINE_PLUGINS']:
-            entry_points = importlib_entry_points(group=app.config['PLUGINENGINE_NAMESPACE'], name=name)
-            if not entry_points:
-                state.logger.error('Plugin %s does not exist', name)
-                state.failed.add(name)
-                continue
-            elif len(entry_points) > 1:
-                defs = ', '.join(ep.module for ep in entry_points)
-                state.logger.error('Plugin name %s is not unique (defined in %s)', name, defs)
-                state.failed.add(name)
-                continue
-            entry_point = list(entry_points)[0]
+            start = time.perf_counter()
+            memory = get_traced_memory() if track_memory else None
+            audit = ImportAudit(name) if audit_imports else nullcontext()
             try:
-                plugin_class = entry_point.load()
-            except ImportError:
-                state.logger.exception('Could not load plugin %s', name)
-                state.failed.add(name)
+                with audit:
+                    plugin_class = registry.resolve(app.config['PLUGINENGINE_NAMESPACE'], name, self.plugin_class)
+            except PluginLoadError as exc:
+                if exc.phase == 'import':
+                    state.logger.exception('Could not load plugin %s', name)
+                else:
+                    state.logger.error('Could not load plugin %s: %s', name, exc.message)
+                state.add_failure(name, exc.phase, exc.message, exc.__cause__, start=start)
                 continue
-            if not issubclass(plugin_class, self.plugin_class):
-                state.logger.error('Plugin %s does not inherit from %s', name, self.plugin_class.__name__)
-                state.failed.add(name)
-                continue
-            plugin_class.package_name = entry_point.module.split('.')[0]
-            plugin_class.package_version = entry_point.dist.version
-            if plugin_class.version is None:
-                plugin_class.version = plugin_class.package_version
-            plugin_class.name = name
-            plugin_class.root_path = get_root_path(entry_point.module)
+            finally:
+                if audit_imports:
+                    state.import_reports[name] = audit.report
             plugins[name] = plugin_class
+            state.import_times[name] = time.perf_counter() - start
+            if track_memory:
+                state.import_memory[name] = get_traced_memory() - memory
         return plugins
 
+    def _skip_unresolvable(self, state, plugins):
+        """Remove plugins whose hard dependencies cannot be loaded.
+
+        :param state: The plugin engine state of the application
+        :param plugins: A dict mapping plugin names to plugin classes;
+                        unresolvable plugins are removed from it
+        """
+        for name, missing in sorted(find_unresolvable_plugins(plugins).items()):
+            deps = ', '.join(sorted(missing))
+            state.logger.error('Plugin %s has unresolvable dependencies: %s', name, deps)
+            state.add_failure(name, 'dependency', f'Unresolvable dependencies: {deps}',
+                              elapsed=state.import_times.get(name, 0))
+            del plugins[name]
+
     def get_failed_plugins(self, app=None):
         """Return the list of plugins which could not be loaded.
 
         :param app: A Flask app. Defaults to the current app.
         """
         state = get_state(app or current_app)
-        return frozenset(state.failed)
+        return state.failed_plugins
+
+    def get_failure_report(self, app=None):
+        """Return detailed information about plugins which could not be loaded.
+
+        :param app: A Flask app. Defaults to the current app.
+        :return: dict mapping plugin names to :class:`PluginLoadFailure` objects
+        """
+        state = get_state(app or current_app)
+        return state.failure_report
+
+    def get_dependency_graph(self, app=None):
+        """Return the dependency graph of the active plugins.
+
+        :param app: A Flask app. Defaults to the current app.
+        :return: A :class:`~flask_pluginengine.graph.DependencyGraph`
+        """
+        state = get_state(app or current_app)
+        return state.dependency_graph
+
+    def get_import_report(self, app=None):
+        """Return information about the modules imported by each plugin.
+
+        This is only available if ``PLUGINENGINE_AUDIT_IMPORTS`` was
+        enabled when loading the plugins.  Modules are only recorded
+        for the plugin which imported them first, and plugins which had
+        already been imported before (e.g. through a shared registry)
+        do not import any new modules.
+
+        :param app: A Flask app. Defaults to the current app.
+        :return: dict mapping plugin names to
+                 :class:`~flask_pluginengine.audit.PluginImportReport` objects
+        """
+        state = get_state(app or current_app)
+        return ImmutableDict(state.import_reports)
+
+    def get_memory_report(self, app=None):
+        """Return the memory allocated while loading each plugin.
+
+        This is only available if ``PLUGINENGINE_TRACK_MEMORY`` was
+        enabled when loading the plugins.  Plugins which had already
+        been imported before (e.g. through a shared registry) do not
+        allocate any memory while being imported.
+
+        :param app: A Flask app. Defaults to the current app.
+        :return: dict mapping plugin names to
+                 :class:`~flask_pluginengine.memory.PluginMemoryUsage` objects
+        """
+        state = get_state(app or current_app)
+        names = list(state.import_memory)
+        names += [name for name in state.init_memory if name not in state.import_memory]
+        return ImmutableDict((name, PluginMemoryUsage(name, state.import_memory.get(name),
+                                                      state.init_memory.get(name)))
+                             for name in names)
+
+    def estimate_plugin_size(self, name, app=None):
+        """Estimate the memory used by the objects reachable from a plugin.
+
+        Objects shared with the rest of the application (such as the app
+        itself, other plugins, classes, modules and functions) are not
+        counted.  This needs to traverse all the objects, so it should
+        not be used while handling requests.
+
+        :param name: The name of the plugin
+        :param app: A Flask app. Defaults to the current app.
+        :return: The estimated size in bytes
+        """
+        state = get_state(app or current_app)
+        plugin = state.plugins[name]
+        others = [p for p in state.plugins.values() if p is not plugin]
+        return estimate_size(plugin, exclude=[state.app, state, self, state.logger, *others])
 
     def get_active_plugins(self, app=None):
         """Return the currently active plugins.
@@ -103,7 +298,16 @@ class PluginEngine:
         :return: dict mapping plugin names to plugin instances
         """
         state = get_state(app or current_app)
-        return ImmutableDict(state.plugins)
+        return state.active_plugins
+
+    def iter_active_plugins(self, app=None):
+        """Iterate over the currently active plugins in the order they were loaded.
+
+        :param app: A Flask app. Defaults to the current app.
+        :return: iterator yielding plugin instances
+        """
+        state = get_state(app or current_app)
+        return iter(state.active_plugins.values())
 
     def has_plugin(self, name, app=None):
         """Return if a plugin is loaded in the current app.
@@ -123,18 +327,266 @@ class PluginEngine:
         state = get_state(app or current_app)
         return state.plugins.get(name)
 
+    def call_hook(self, name, *args, **kwargs):
+        """Call all implementations of a hook in the current app.
+
+        The implementations are called in the order the plugins were
+        loaded, i.e. a plugin's implementation is always called after
+        those of the plugins it depends on.  Each implementation runs
+        in the context of its plugin.
+
+        :param name: The name of the hook
+        :param args: Positional arguments passed to the implementations
+        :param kwargs: Keyword arguments passed to the implementations
+        :return: list containing the return values of all implementations
+        """
+        return [func(*args, **kwargs) for func in get_state(current_app).hooks.get(name, ())]
+
+    def call_hook_first(self, name, *args, **kwargs):
+        """Call the implementations of a hook until one returns a value.
+
+        This works like :meth:`call_hook`, but stops calling the hook
+        implementations as soon as one of them returns something other
+        than ``None``.
+
+        :return: The first return value which is not ``None``, or ``None``
+                 if all implementations returned ``None``
+        """
+        for func in get_state(current_app).hooks.get(name, ()):
+            rv = func(*args, **kwargs)
+            if rv is not None:
+                return rv
+        return None
+
+    def get_hook_implementations(self, name, app=None):
+        """Return the plugins implementing a hook.
+
+        :param name: The name of the hook
+        :param app: A Flask app. Defaults to the current app.
+        :return: tuple containing the plugin instances in the order in
+                 which their implementations are called
+        """
+        state = get_state(app or current_app)
+        return state.hook_plugins.get(name, ())
+
+    def get_budget_violations(self, app=None):
+        """Return how often plugins exceeded their budgets.
+
+        :param app: A Flask app. Defaults to the current app.
+        :return: dict mapping plugin names to dicts mapping the kind of
+                 the budget (``time`` or ``memory``) to the number of
+                 calls which exceeded it
+        """
+        state = get_state(app or current_app)
+        return state.budget_violations
+
+    def start_profiler(self, interval=0.005):
+        """Start sampling which plugins the threads of this process run code for.
+
+        The profiler keeps its samples after being stopped. Starting it
+        again discards the old samples.
+
+        :param interval: The number of seconds between two samples
+        :return: The :class:`~flask_pluginengine.profiler.PluginProfiler`
+        """
+        if self.profiler is not None and self.profiler.running:
+            raise RuntimeError('Profiler is already running')
+        self.profiler = PluginProfiler(interval)
+        self.profiler.start()
+        return self.profiler
+
+    def stop_profiler(self):
+        """Stop the profiler started using :meth:`start_profiler`.
+
+        :return: The :class:`~flask_pluginengine.profiler.PluginProfiler`
+        """
+        if self.profiler is None or not self.profiler.running:
+            raise RuntimeError('Profiler is not running')
+        self.profiler.stop()
+        return self.profiler
+
+    def get_plugin_for_endpoint(self, endpoint, app=None):
+        """Return the plugin owning an endpoint.
+
+        This is a simple lookup which does not need a plugin context,
+        so it can be used e.g. with ``request.endpoint`` to find out
+        which plugin handles the current request.
+
+        :param endpoint: The full name of the endpoint
+        :param app: A Flask app. Defaults to the current app.
+        :return: The plugin instance or ``None`` if the endpoint does
+                 not belong to a plugin blueprint.
+        """
+        state = get_state(app or current_app)
+        return state.endpoint_plugins.get(endpoint)
+
+    def get_plugin_for_blueprint(self, name, app=None):
+        """Return the plugin owning a blueprint.
+
+        :param name: The full name of the blueprint, e.g. ``request.blueprint``
+        :param app: A Flask app. Defaults to the current app.
+        :return: The plugin instance or ``None`` if the blueprint is not
+                 a plugin blueprint.
+        """
+        state = get_state(app or current_app)
+        return state.blueprint_plugins.get(name)
+
+    def get_plugin_endpoints(self, name, app=None):
+        """Return the endpoints of a plugin's blueprints.
+
+        :param name: The name of the plugin
+        :param app: A Flask app. Defaults to the current app.
+        :return: A frozenset containing the full endpoint names
+        """
+        state = get_state(app or current_app)
+        return state.plugin_endpoints.get(name, frozenset())
+
     def __repr__(self):
         return '<PluginEngine()>'
 
 
 class _PluginEngineState:
+    __slots__ = ('plugin_engine', 'app', 'logger', 'plugins', 'failed', 'import_times', 'import_reports',
+                 'import_memory', 'init_memory', 'dependency_graph', 'blueprint_plugins', 'endpoint_plugins',
+                 '_plugin_endpoints', 'plugins_loaded', '_active_plugins', '_failure_report', '_failed_plugins',
+                 '_hooks', '_hook_plugins', '_budget_violations', '_budget_violations_lock', '_fragment_cache')
+
     def __init__(self, plugin_engine, app, logger):
         self.plugin_engine = plugin_engine
         self.app = app
         self.logger = logger
         self.plugins = {}
-        self.failed = set()
+        self.failed = {}
+        self.import_times = {}
+        self.import_reports = {}
+        self.import_memory = {}
+        self.init_memory = {}
+        self.dependency_graph = DependencyGraph({}, [])
+        self.blueprint_plugins = {}
+        self.endpoint_plugins = {}
+        self._plugin_endpoints = None
         self.plugins_loaded = False
+        self._active_plugins = None
+        self._failure_report = None
+        self._failed_plugins = None
+        self._hooks = None
+        self._hook_plugins = None
+        self._budget_violations = Counter()
+        self._budget_violations_lock = threading.Lock()
+        self._fragment_cache = None
+
+    @property
+    def active_plugins(self):
+        """Immutable snapshot of :attr:`plugins`.
+
+        The snapshot is only rebuilt after :meth:`plugins_changed` has
+        been called.
+        """
+        if self._active_plugins is None:
+            self._active_plugins = ImmutableDict(self.plugins)
+        return self._active_plugins
+
+    @property
+    def hooks(self):
+        """dict mapping hook names to the functions implementing them.
+
+        The functions are already wrapped to run in the context of their
+        plugins.
+        """
+        if self._hooks is None:
+            self._build_hooks()
+        return self._hooks
+
+    @property
+    def hook_plugins(self):
+        """dict mapping hook names to the plugins implementing them."""
+        if self._hook_plugins is None:
+            self._build_hooks()
+        return self._hook_plugins
+
+    def _build_hooks(self):
+        hooks = {}
+        hook_plugins = {}
+        for plugin in self.active_plugins.values():
+            for attr, hook_name in get_hook_methods(type(plugin)).items():
+                func = wrap_in_plugin_context(plugin, getattr(plugin, attr), skippable=True)
+                hooks.setdefault(hook_name, []).append(func)
+                hook_plugins.setdefault(hook_name, []).append(plugin)
+        self._hooks = {name: tuple(funcs) for name, funcs in hooks.items()}
+        self._hook_plugins = {name: tuple(plugins) for name, plugins in hook_plugins.items()}
+
+    @property
+    def failure_report(self):
+        """Immutable snapshot of :attr:`failed`."""
+        if self._failure_report is None:
+            self._failure_report = ImmutableDict(self.failed)
+        return self._failure_report
+
+    @property
+    def failed_plugins(self):
+        """The names of all plugins that could not be loaded."""
+        if self._failed_plugins is None:
+            self._failed_plugins = frozenset(self.failed)
+        return self._failed_plugins
+
+    def plugins_changed(self):
+        """Discard the snapshot of the active plugins.
+
+        This must be called after modifying :attr:`plugins`.
+        """
+        self._active_plugins = None
+        self._hooks = self._hook_plugins = None
+        if self._fragment_cache is not None:
+            self._fragment_cache.clear()
+
+    @property
+    def fragment_cache(self):
+        """The template fragment cache (see :func:`~flask_pluginengine.caching.get_fragment_cache`)."""
+        if self._fragment_cache is None:
+            cache = self.app.config.get('PLUGINENGINE_FRAGMENT_CACHE')
+            if not cache:
+                return None
+            self._fragment_cache = LRUFragmentCache() if cache is True else cache
+        return self._fragment_cache
+
+    def add_endpoint(self, blueprint_name, endpoint, plugin):
+        """Record the plugin owning a blueprint endpoint."""
+        self.blueprint_plugins[blueprint_name] = plugin
+        self.endpoint_plugins[endpoint] = plugin
+        self._plugin_endpoints = None
+
+    @property
+    def plugin_endpoints(self):
+        """dict mapping plugin names to the endpoints of the plugin."""
+        if self._plugin_endpoints is None:
+            endpoints = {}
+            for endpoint, plugin in self.endpoint_plugins.items():
+                if plugin is not None:
+                    endpoints.setdefault(plugin.name, set()).add(endpoint)
+            self._plugin_endpoints = ImmutableDict((name, frozenset(names)) for name, names in endpoints.items())
+        return self._plugin_endpoints
+
+    def record_budget_violation(self, name, kind):
+        """Count a call that exceeded the budget of a plugin."""
+        with self._budget_violations_lock:
+            self._budget_violations[name, kind] += 1
+
+    @property
+    def budget_violations(self):
+        """dict mapping plugin names to dicts containing violation counts."""
+        with self._budget_violations_lock:
+            items = list(self._budget_violations.items())
+        violations = {}
+        for (name, kind), count in items:
+            violations.setdefault(name, {})[kind] = count
+        return violations
+
+    def add_failure(self, name, phase, message, exception=None, start=None, elapsed=None):
+        """Record a plugin that could not be loaded."""
+        if elapsed is None:
+            elapsed = time.perf_counter() - start
+        self.failed[name] = PluginLoadFailure(name, phase, message, exception, elapsed)
+        self._failure_report = self._failed_plugins = None
 
     def __repr__(self):
         return f'<_PluginEngineState({self.plugin_engine}, {self.app}, {self.plugins})>'
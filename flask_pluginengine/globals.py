@@ -4,10 +4,156 @@
 # Flask-PluginEngine is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
-from werkzeug.local import LocalProxy, LocalStack
+from contextvars import ContextVar
+from threading import Lock, get_ident
 
+from werkzeug.local import LocalProxy
+
+
+class _PluginContextStack:
+    """Stack of active plugins stored in a context variable.
+
+    The stack is an immutable linked list of ``(plugin, parent)`` tuples,
+    so pushing or popping a plugin never modifies a stack which may still
+    be visible in another context (e.g. a copied context of a thread, a
+    greenlet or an asyncio task).  Since context variables are local to
+    the current thread, greenlet and asyncio task, each of them has its
+    own stack.
+
+    Context variables cannot be read from other threads, so while thread
+    tracking is enabled (i.e. while a :class:`~flask_pluginengine.profiler.PluginProfiler`
+    is running), the topmost plugin is also stored per thread whenever
+    the stack changes.
+    """
+
+    __slots__ = ('_var', '_thread_plugins', '_tracking', '_tracking_lock')
+
+    _empty = (None, None)
+
+    def __init__(self, name):
+        self._var = ContextVar(name, default=self._empty)
+        self._thread_plugins = {}
+        self._tracking = 0
+        self._tracking_lock = Lock()
+
+    def push(self, plugin):
+        """Push a plugin (or ``None``) on the stack.
+
+        :return: A token which can be passed to :meth:`pop`
+        """
+        token = self._var.set((plugin, self._var.get()))
+        if self._tracking:
+            self._thread_plugins[get_ident()] = plugin
+        return token
+
+    def pop(self, token=None):
+        """Pop the topmost plugin from the stack.
+
+        :param token: The token returned when pushing the plugin.  If
+                      provided, the stack is restored to the state from
+                      before the plugin was pushed, which fails if the
+                      current context is not the one it was pushed in.
+        :return: The popped plugin
+        """
+        plugin, parent = self._var.get()
+        if token is not None:
+            self._var.reset(token)
+        elif parent is not None:
+            self._var.set(parent)
+        if self._tracking:
+            self.sync_thread()
+        return plugin
+
+    def sync_thread(self):
+        """Store the topmost plugin of the current context for the current thread.
+
+        This needs to be called after switching to a different context
+        without changing the stack (e.g. using :meth:`contextvars.Context.run`).
+        It does nothing unless thread tracking is enabled.
+        """
+        if not self._tracking:
+            return
+        node = self._var.get()
+        if node is self._empty:
+            self._thread_plugins.pop(get_ident(), None)
+        else:
+            self._thread_plugins[get_ident()] = node[0]
+
+    def derive(self, plugin):
+        """Get the current stack with a plugin pushed, without activating it.
+
+        The returned stack can be activated later using :meth:`activate`.
+        """
+        return (plugin, self._var.get())
+
+    def activate(self, stack):
+        """Replace the current stack with a stack from :meth:`derive` or :meth:`deactivate`.
+
+        :return: A token which needs to be passed to :meth:`deactivate`
+        """
+        token = self._var.set(stack)
+        if self._tracking:
+            self.sync_thread()
+        return token
+
+    def deactivate(self, token):
+        """Restore the stack which was replaced by :meth:`activate`.
+
+        :return: The stack which was active, including any changes made
+                 to it since it was activated
+        """
+        stack = self._var.get()
+        self._var.reset(token)
+        if self._tracking:
+            self.sync_thread()
+        return stack
+
+    def start_tracking(self):
+        """Start storing the topmost plugin of each thread.
+
+        Threads which are already inside a plugin context are only
+        tracked once their stack changes.  Each call needs to be paired
+        with a call to :meth:`stop_tracking`.
+        """
+        with self._tracking_lock:
+            self._tracking += 1
+
+    def stop_tracking(self):
+        """Stop storing the topmost plugin of each thread."""
+        with self._tracking_lock:
+            self._tracking -= 1
+            if not self._tracking:
+                self._thread_plugins.clear()
+
+    @property
+    def top(self):
+        """The topmost plugin or ``None`` if the stack is empty."""
+        return self._var.get()[0]
+
+    @property
+    def thread_plugins(self):
+        """The topmost plugin of each tracked thread with a non-empty stack.
+
+        For threads running multiple contexts (e.g. asyncio tasks or
+        greenlets), this is the plugin of the context whose stack was
+        changed most recently.
+        """
+        return self._thread_plugins.copy()
+
+
+_plugin_ctx_stack = _PluginContextStack('flask_pluginengine.plugin_ctx_stack')
+
+
+def get_current_plugin():
+    """Return the currently active plugin.
+
+    This returns the actual plugin object (or ``None`` if there is no
+    active plugin) and avoids the overhead of going through the
+    :data:`current_plugin` proxy, which is useful in code that accesses
+    the current plugin very often.
+    """
+    return _plugin_ctx_stack.top
 
-_plugin_ctx_stack = LocalStack()
 
 #: Proxy to the currently active plugin
-current_plugin = LocalProxy(lambda: _plugin_ctx_stack.top)
+current_plugin = LocalProxy(get_current_plugin)
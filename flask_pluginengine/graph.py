@@ -0,0 +1,122 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+from werkzeug.datastructures import ImmutableDict
+
+
+class DependencyGraph:
+    """Dependency graph of the active plugins of an application.
+
+    The graph is built once when the plugins are loaded and never
+    changes afterwards, so all queries are simple lookups.  Only
+    dependencies between active plugins are included, i.e. soft
+    dependencies on plugins which are not loaded are ignored.
+
+    :param plugins: dict mapping plugin names to plugin classes
+    :param levels: list containing a list of plugin names for each
+                   dependency level, in the order the plugins were loaded
+    """
+
+    def __init__(self, plugins, levels):
+        self.levels = tuple(tuple(level) for level in levels)
+        self._levels = ImmutableDict((name, i) for i, level in enumerate(self.levels) for name in level)
+        self._requires = ImmutableDict((name, frozenset(cls.required_plugins & plugins.keys()))
+                                       for name, cls in plugins.items())
+        self._uses = ImmutableDict((name, frozenset(cls.used_plugins & plugins.keys()))
+                                   for name, cls in plugins.items())
+        self._dependencies = ImmutableDict((name, self._requires[name] | self._uses[name]) for name in plugins)
+        dependents = {name: set() for name in plugins}
+        for name, deps in self._dependencies.items():
+            for dep in deps:
+                dependents[dep].add(name)
+        self._dependents = ImmutableDict((name, frozenset(deps)) for name, deps in dependents.items())
+        self._all_dependencies = self._build_closure(self._dependencies)
+        self._all_dependents = self._build_closure(self._dependents)
+
+    @staticmethod
+    def _build_closure(adjacency):
+        closure = {}
+        for name in adjacency:
+            seen = set()
+            pending = list(adjacency[name])
+            while pending:
+                node = pending.pop()
+                if node not in seen:
+                    seen.add(node)
+                    pending.extend(adjacency[node])
+            seen.discard(name)
+            closure[name] = frozenset(seen)
+        return ImmutableDict(closure)
+
+    def __contains__(self, name):
+        return name in self._dependencies
+
+    def __iter__(self):
+        return iter(self._dependencies)
+
+    def __len__(self):
+        return len(self._dependencies)
+
+    def requires(self, name):
+        """Get the active plugins a plugin has hard dependencies on."""
+        return self._requires[name]
+
+    def uses(self, name):
+        """Get the active plugins a plugin has soft dependencies on."""
+        return self._uses[name]
+
+    def dependencies(self, name):
+        """Get the active plugins a plugin directly depends on."""
+        return self._dependencies[name]
+
+    def dependents(self, name):
+        """Get the active plugins directly depending on a plugin."""
+        return self._dependents[name]
+
+    def all_dependencies(self, name):
+        """Get the active plugins a plugin directly or indirectly depends on."""
+        return self._all_dependencies[name]
+
+    def all_dependents(self, name):
+        """Get the active plugins directly or indirectly depending on a plugin."""
+        return self._all_dependents[name]
+
+    def level(self, name):
+        """Get the dependency level of a plugin.
+
+        Plugins only have hard dependencies on plugins on lower levels.
+        The same is true for soft dependencies unless they form a cycle:
+        then all remaining plugins whose hard dependencies are met are
+        placed on the same level, so a plugin may share its level with
+        plugins it soft-depends on.
+        """
+        return self._levels[name]
+
+    def to_dict(self):
+        """Export the graph as a JSON-serializable dict."""
+        return {
+            'plugins': list(self),
+            'levels': [list(level) for level in self.levels],
+            'edges': [{'from': name, 'to': dep, 'hard': dep in self._requires[name]}
+                      for name in self for dep in sorted(self._dependencies[name])],
+        }
+
+    def to_dot(self):
+        """Export the graph in the Graphviz DOT format.
+
+        Soft dependencies are shown as dashed edges.
+        """
+        lines = ['digraph plugins {']
+        lines += [f'    "{name}";' for name in self]
+        for name in self:
+            for dep in sorted(self._dependencies[name]):
+                style = '' if dep in self._requires[name] else ' [style=dashed]'
+                lines.append(f'    "{name}" -> "{dep}"{style};')
+        lines.append('}')
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return f'<DependencyGraph({", ".join(self)})>'
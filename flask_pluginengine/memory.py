@@ -0,0 +1,86 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import gc
+import sys
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
+from types import BuiltinFunctionType, CodeType, FrameType, FunctionType, MethodType, ModuleType
+
+
+class PluginMemoryUsage(namedtuple('PluginMemoryUsage', ('name', 'import_memory', 'init_memory'))):
+    """Memory allocated while loading a plugin.
+
+    The values are the number of bytes allocated (and not freed again)
+    while importing the plugin and while initializing it.  They are
+    ``None`` if the plugin did not reach that phase.  If plugins are
+    initialized in parallel, allocations of plugins initialized at the
+    same time are attributed to all of them.
+
+    :param name: The name of the plugin
+    :param import_memory: The memory allocated while importing the plugin
+    :param init_memory: The memory allocated while initializing the plugin
+    """
+
+    __slots__ = ()
+
+    @property
+    def total(self):
+        return (self.import_memory or 0) + (self.init_memory or 0)
+
+
+@contextmanager
+def tracing_memory(enabled=True):
+    """Make sure :mod:`tracemalloc` is tracing inside the block.
+
+    If it is not tracing yet, it is stopped again when leaving the block.
+
+    :param enabled: Whether to do anything at all
+    """
+    if not enabled or tracemalloc.is_tracing():
+        yield
+        return
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        tracemalloc.stop()
+
+
+def get_traced_memory():
+    """Get the currently allocated memory traced by :mod:`tracemalloc`."""
+    return tracemalloc.get_traced_memory()[0]
+
+
+# objects which usually belong to code shared by everything in the process
+_shared_types = (type, ModuleType, FunctionType, BuiltinFunctionType, MethodType, CodeType, FrameType)
+
+
+def estimate_size(obj, exclude=()):
+    """Estimate the memory used by an object and the objects it references.
+
+    The traversal stops at classes, modules, functions and the objects
+    passed in `exclude` since those are usually shared with other code.
+    The result is only an estimate: objects referenced by the object are
+    counted even if they are also referenced from elsewhere.
+
+    :param obj: The object to measure
+    :param exclude: Objects which should not be counted (including the
+                    objects only reachable through them)
+    :return: The estimated size in bytes
+    """
+    seen = {id(x) for x in exclude}
+    pending = [obj]
+    size = 0
+    while pending:
+        current = pending.pop()
+        if id(current) in seen or (current is not obj and isinstance(current, _shared_types)):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        pending.extend(gc.get_referents(current))
+    return size
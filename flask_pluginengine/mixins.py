@@ -4,27 +4,85 @@
 # Flask-PluginEngine is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
-from flask import Blueprint, Flask
+import hashlib
+import mimetypes
+import os
+import threading
+from contextvars import ContextVar
+
+from flask import Blueprint, Flask, current_app, request, send_from_directory
 from flask.blueprints import BlueprintSetupState
 from jinja2 import ChoiceLoader
+from werkzeug.datastructures import ImmutableDict
+from werkzeug.routing import Rule
 from werkzeug.utils import cached_property
 
-from .globals import current_plugin
-from .templating import PluginEnvironment, PluginPrefixLoader
+from .globals import get_current_plugin
+from .templating import PluginEnvironment, PluginPrefixLoader, shared_template_cache
 from .util import wrap_in_plugin_context
 
 
+# file extensions of precompressed static files
+_static_encodings = {'.br': 'br', '.gz': 'gzip'}
+_static_suffixes = {encoding: suffix for suffix, encoding in _static_encodings.items()}
+
+# set while the URL rule of a plugin blueprint is being added to the app
+_adding_plugin_rule = ContextVar('flask_pluginengine.adding_plugin_rule', default=False)
+
+
+def _hash_file(path, chunk_size=65536):
+    # read the file in chunks so large static files are not loaded into memory at once
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()[:12]
+
+
 class PluginBlueprintSetupStateMixin:
     def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
         func = view_func
         if view_func is not None:
-            plugin = current_plugin._get_current_object()
+            plugin = get_current_plugin()
             func = wrap_in_plugin_context(plugin, view_func)
+            if endpoint is None:
+                endpoint = view_func.__name__
+            self._index_endpoint(plugin, endpoint)
+
+        token = _adding_plugin_rule.set(True)
+        try:
+            super().add_url_rule(rule, endpoint, func, **options)
+        finally:
+            _adding_plugin_rule.reset(token)
 
-        super().add_url_rule(rule, endpoint, func, **options)
+    def _index_endpoint(self, plugin, endpoint):
+        # Remember which plugin owns the endpoint so it can be looked up
+        # without having to parse the endpoint or blueprint name
+        state = self.app.extensions.get('pluginengine')
+        if state is None:
+            return
+        blueprint_name = f'{self.name_prefix}.{self.name}'.lstrip('.')
+        state.add_endpoint(blueprint_name, f'{blueprint_name}.{endpoint}', plugin)
 
 
 class PluginBlueprintMixin:
+    """Mixin for blueprints of plugins.
+
+    Static files are served with support for precompressed variants: if
+    a file named e.g. ``app.js.br`` or ``app.js.gz`` exists next to
+    ``app.js``, it is sent instead of the original file to clients
+    accepting that encoding.
+
+    When the blueprint is registered, a manifest containing the content
+    hash of each static file is built (see :attr:`static_manifest`).
+    URLs built with :func:`~flask_pluginengine.url_for_plugin_static`
+    contain that hash, and static files requested with the current hash
+    are sent with headers allowing clients to cache them for a long time.
+    """
+
+    #: The number of seconds clients may cache fingerprinted static files
+    static_cache_max_age = 365 * 24 * 3600
+
     def __init__(self, name, *args, **kwargs):
         if 'template_folder' in kwargs:
             raise ValueError('Template folder cannot be specified')
@@ -36,18 +94,164 @@ class PluginBlueprintMixin:
     def make_setup_state(self, app, options, first_registration=False):
         return PluginBlueprintSetupState(self, app, options, first_registration)
 
+    def register(self, app, options):
+        # build the manifest while loading the plugins instead of during the first request
+        self._static_files
+        super().register(app, options)
+
+    @cached_property
+    def _static_files(self):
+        manifest = {}
+        precompressed = {}
+        if not self.has_static_folder or not os.path.isdir(self.static_folder):
+            return ImmutableDict(), ImmutableDict()
+        for root, dirs, files in os.walk(self.static_folder):
+            for name in files:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                base, ext = os.path.splitext(filename)
+                encoding = _static_encodings.get(ext)
+                if encoding is not None:
+                    precompressed.setdefault(base, set()).add(encoding)
+                    continue
+                manifest[filename] = _hash_file(path)
+        precompressed = {filename: frozenset(encodings) for filename, encodings in precompressed.items()
+                         if filename in manifest}
+        return ImmutableDict(manifest), ImmutableDict(precompressed)
+
+    @property
+    def static_manifest(self):
+        """dict mapping the names of static files to a hash of their content."""
+        return self._static_files[0]
+
+    def _get_static_encoding(self, filename):
+        available = self._static_files[1].get(filename)
+        if not available:
+            return None
+        accepted = [(request.accept_encodings[encoding], encoding == 'br', encoding) for encoding in available]
+        quality, __, encoding = max(accepted)
+        return encoding if quality else None
+
+    def send_static_file(self, filename):
+        if not self.has_static_folder:
+            return super().send_static_file(filename)
+        fingerprint = self.static_manifest.get(filename)
+        immutable = fingerprint is not None and request.args.get('v') == fingerprint and not current_app.debug
+        max_age = self.static_cache_max_age if immutable else self.get_send_file_max_age(filename)
+        encoding = self._get_static_encoding(filename)
+        if encoding is None:
+            rv = send_from_directory(self.static_folder, filename, max_age=max_age)
+        else:
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            rv = send_from_directory(self.static_folder, filename + _static_suffixes[encoding], max_age=max_age,
+                                     mimetype=mimetype)
+            rv.content_encoding = encoding
+        if filename in self._static_files[1]:
+            rv.vary.add('Accept-Encoding')
+        if immutable:
+            rv.cache_control.public = True
+            rv.cache_control.immutable = True
+        return rv
+
     @cached_property
     def jinja_loader(self):
         return None
 
 
+class LazyBuilderRule(Rule):
+    """URL rule which only compiles its URL builders when building a URL.
+
+    Werkzeug generates Python code for building the URLs of a rule as soon
+    as the rule is added to the URL map, which is the most expensive part
+    of registering a rule.  Many endpoints are never used with ``url_for``
+    (or only long after the application started), so this is deferred until
+    the first URL is built using the rule.
+
+    This relies on an internal method of Werkzeug's :class:`~werkzeug.routing.Rule`,
+    so it is only used for the rules of plugin blueprints.
+    """
+
+    def _compile_builder(self, append_unknown=True):
+        compile_builder = super()._compile_builder
+        builder = None
+
+        def build(rule, *args, **kwargs):
+            nonlocal builder
+            if builder is None:
+                builder = compile_builder(append_unknown).__get__(rule, None)
+            return builder(*args, **kwargs)
+
+        return build
+
+
 class PluginFlaskMixin:
+    """Mixin for Flask applications supporting plugin templates.
+
+    If ``PLUGINENGINE_SHARE_TEMPLATES`` is enabled, all applications with
+    this setting share the plugin template loader and the compiled code of
+    their templates (unless a different ``bytecode_cache`` is set in the
+    :attr:`jinja_options`), so each template is only compiled once per
+    process.  The applications should use the same Jinja settings.
+
+    The URL rules of plugin blueprints use :attr:`plugin_url_rule_class`,
+    while all other rules use the regular :attr:`url_rule_class`, which
+    can still be customized on the application or in a subclass.
+    """
+
     plugin_jinja_loader = PluginPrefixLoader
+    plugin_url_rule_class = LazyBuilderRule
     jinja_environment = PluginEnvironment
 
+    # set when assigning a custom `url_rule_class`
+    _url_rule_class = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # keep the property below when a subclass sets `url_rule_class`
+        url_rule_class = cls.__dict__.get('url_rule_class')
+        if url_rule_class is not None and not isinstance(url_rule_class, property):
+            del cls.url_rule_class
+            cls._url_rule_class = url_rule_class
+
+    @property
+    def url_rule_class(self):
+        if _adding_plugin_rule.get():
+            return self.plugin_url_rule_class
+        elif self._url_rule_class is not None:
+            return self._url_rule_class
+        return super().url_rule_class
+
+    @url_rule_class.setter
+    def url_rule_class(self, value):
+        self._url_rule_class = value
+
+    def create_jinja_environment(self):
+        rv = super().create_jinja_environment()
+        if self.config.get('PLUGINENGINE_SHARE_TEMPLATES') and rv.bytecode_cache is None:
+            rv.bytecode_cache = shared_template_cache
+        return rv
+
     def create_global_jinja_loader(self):
         default_loader = super().create_global_jinja_loader()
-        return ChoiceLoader([self.plugin_jinja_loader(self), default_loader])
+        if self.config.get('PLUGINENGINE_SHARE_TEMPLATES'):
+            plugin_loader = _get_shared_loader(self.plugin_jinja_loader)
+        else:
+            plugin_loader = self.plugin_jinja_loader(self)
+        return ChoiceLoader([plugin_loader, default_loader])
+
+
+_shared_loaders = {}
+_shared_loaders_lock = threading.Lock()
+
+
+def _get_shared_loader(loader_class):
+    """Get a plugin template loader which is not bound to a specific app."""
+    with _shared_loaders_lock:
+        try:
+            return _shared_loaders[loader_class]
+        except KeyError:
+            rv = _shared_loaders[loader_class] = loader_class()
+            return rv
 
 
 class PluginBlueprintSetupState(PluginBlueprintSetupStateMixin, BlueprintSetupState):
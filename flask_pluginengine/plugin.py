@@ -4,12 +4,13 @@
 # Flask-PluginEngine is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+from collections import namedtuple
 from contextlib import contextmanager
 
-from flask import current_app, render_template, url_for
+from flask import current_app, render_template, stream_template, url_for
 
-from .globals import _plugin_ctx_stack, current_plugin
-from .util import classproperty, get_state, trim_docstring, wrap_in_plugin_context
+from .globals import _plugin_ctx_stack, get_current_plugin
+from .util import classproperty, get_state, trim_docstring, wrap_in_plugin_context, wrap_iterator_in_plugin_context
 
 
 def depends(*plugins):
@@ -24,6 +25,7 @@ def depends(*plugins):
 
     def wrapper(cls):
         cls.required_plugins |= frozenset(plugins)
+        cls._metadata = None
         return cls
 
     return wrapper
@@ -45,11 +47,69 @@ def uses(*plugins):
 
     def wrapper(cls):
         cls.used_plugins |= frozenset(plugins)
+        cls._metadata = None
         return cls
 
     return wrapper
 
 
+def hook(name=None):
+    """Marks a plugin method as an implementation of a hook.
+
+    The engine collects all hook implementations of the active plugins
+    when they are loaded; they can then be called using
+    :meth:`~flask_pluginengine.PluginEngine.call_hook`.
+
+    :param name: The name of the hook. Defaults to the name of the
+                 method. The decorator may also be used without
+                 parentheses in that case.
+    """
+
+    if callable(name):
+        return hook()(name)
+
+    def decorator(f):
+        f._plugin_hook = name or f.__name__
+        return f
+
+    return decorator
+
+
+def get_hook_methods(plugin_class):
+    """Get the hook implementations of a plugin class.
+
+    Only the most specific definition of a method is considered, so
+    overriding a hook implementation in a subclass requires using the
+    :func:`hook` decorator again.
+
+    :return: dict mapping method names to hook names
+    """
+    hooks = {}
+    for cls in reversed(plugin_class.__mro__):
+        for attr, value in vars(cls).items():
+            hook_name = getattr(value, '_plugin_hook', None)
+            if hook_name is not None:
+                hooks[attr] = hook_name
+            else:
+                hooks.pop(attr, None)
+    return hooks
+
+
+def _get_plugin_template_name(template_name_or_list, func_name):
+    """Prefix template names without a plugin name with the current plugin's name."""
+    if not isinstance(template_name_or_list, str):
+        plugin = get_current_plugin()
+        if not plugin and not all(':' in tpl for tpl in template_name_or_list):
+            raise RuntimeError(f'{func_name} outside plugin context')
+        return [f'{plugin.name}:{tpl}' if ':' not in tpl else tpl for tpl in template_name_or_list]
+    elif ':' not in template_name_or_list:
+        plugin = get_current_plugin()
+        if not plugin:
+            raise RuntimeError(f'{func_name} outside plugin context')
+        return f'{plugin.name}:{template_name_or_list}'
+    return template_name_or_list
+
+
 def render_plugin_template(template_name_or_list, **context):
     """Renders a template from the plugin's template folder with the given context.
 
@@ -62,24 +122,68 @@ def render_plugin_template(template_name_or_list, **context):
     :param context: the variables that should be available in the
                     context of the template.
     """
-    if not isinstance(template_name_or_list, str):
-        if not current_plugin and not all(':' in tpl for tpl in template_name_or_list):
-            raise RuntimeError('render_plugin_template outside plugin context')
-        template_name_or_list = [f'{current_plugin.name}:{tpl}' if ':' not in tpl else tpl
-                                 for tpl in template_name_or_list]
-    elif ':' not in template_name_or_list:
-        if not current_plugin:
-            raise RuntimeError('render_plugin_template outside plugin context')
-        template_name_or_list = f'{current_plugin.name}:{template_name_or_list}'
+    template_name_or_list = _get_plugin_template_name(template_name_or_list, 'render_plugin_template')
     return render_template(template_name_or_list, **context)
 
 
+def stream_plugin_template(template_name_or_list, **context):
+    """Renders a template from the plugin's template folder as a stream.
+
+    This works like :func:`render_plugin_template`, but returns an
+    iterator of strings instead of rendering the whole template at once.
+    The plugin context active when calling this function is restored
+    whenever the iterator is advanced, so it can be used as the body of
+    a streamed response.
+
+    :param template_name_or_list: the name of the template or an iterable
+                                  containing template names (the first
+                                  existing template is used)
+    :param context: the variables that should be available in the
+                    context of the template.
+    """
+    template_name_or_list = _get_plugin_template_name(template_name_or_list, 'stream_plugin_template')
+    return wrap_iterator_in_plugin_context(get_current_plugin(), stream_template(template_name_or_list, **context))
+
+
 def url_for_plugin(endpoint, **values):
     """Like url_for but prepending plugin_ to endpoint."""
     endpoint = f'plugin_{endpoint}'
     return url_for(endpoint, **values)
 
 
+def url_for_plugin_static(blueprint, filename, **values):
+    """Like url_for_plugin, but for a static file of a plugin blueprint.
+
+    The URL contains the content hash of the file, so it changes whenever
+    the file changes and clients can cache the file for a long time.
+
+    :param blueprint: The name of the plugin blueprint (without the
+                      ``plugin_`` prefix)
+    :param filename: The name of the file in the static folder
+    :param values: Additional values passed to ``url_for``
+    """
+    name = f'plugin_{blueprint}'
+    manifest = getattr(current_app.blueprints.get(name), 'static_manifest', None)
+    fingerprint = manifest.get(filename) if manifest is not None else None
+    if fingerprint is not None:
+        values['v'] = fingerprint
+    return url_for(f'{name}.static', filename=filename, **values)
+
+
+class PluginMetadata(namedtuple('PluginMetadata', ('name', 'title', 'description', 'version', 'package_name',
+                                                   'package_version', 'required_plugins', 'used_plugins'))):
+    """Class-level information about a plugin."""
+
+    __slots__ = ()
+
+
+def _parse_docstring(docstring):
+    parts = trim_docstring(docstring).split('\n', 1)
+    title = parts[0].strip()
+    description = parts[1].strip() if len(parts) > 1 else 'no description available'
+    return title, description
+
+
 class Plugin:
     package_name = None  # set to the containing package when the plugin is loaded
     package_version = None  # set to the version of the containing package when the plugin is loaded
@@ -88,10 +192,26 @@ class Plugin:
     root_path = None  # set to the path of the module containing the class when the plugin is loaded
     required_plugins = frozenset()
     used_plugins = frozenset()
+    #: The :class:`~flask_pluginengine.budgets.PluginBudget` of the plugin.
+    #: Can be overridden using the ``PLUGINENGINE_BUDGETS`` config setting.
+    budget = None
+    _title, _description = _parse_docstring(None)
+    _metadata = None
+    _entry_point_info = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The docstring never changes, so there's no need to parse it each time
+        # the title or description is accessed.
+        cls._title, cls._description = _parse_docstring(cls.__doc__)
+        cls._metadata = None
 
     def __init__(self, plugin_engine, app):
         self.plugin_engine = plugin_engine
         self.app = app
+        budget = app.config.get('PLUGINENGINE_BUDGETS', {}).get(self.name)
+        if budget is not None:
+            self.budget = budget
         with self.app.app_context():
             with self.plugin_context():
                 self.init()
@@ -120,8 +240,7 @@ class Plugin:
 
         Automatically retrieved from the docstring of the plugin class.
         """
-        parts = trim_docstring(cls.__doc__).split('\n', 1)
-        return parts[0].strip()
+        return cls._title
 
     @classproperty
     @classmethod
@@ -130,24 +249,35 @@ class Plugin:
 
         Automatically retrieved from the docstring of the plugin class.
         """
-        parts = trim_docstring(cls.__doc__).split('\n', 1)
-        try:
-            return parts[1].strip()
-        except IndexError:
-            return 'no description available'
+        return cls._description
+
+    @classproperty
+    @classmethod
+    def metadata(cls):
+        """The class-level information about the plugin.
+
+        This is a :class:`PluginMetadata` object which is only created
+        once after the plugin has been loaded.
+        """
+        metadata = cls.__dict__.get('_metadata')
+        if metadata is None:
+            metadata = cls._metadata = PluginMetadata(cls.name, cls.title, cls.description, cls.version,
+                                                      cls.package_name, cls.package_version, cls.required_plugins,
+                                                      cls.used_plugins)
+        return metadata
 
     @contextmanager
     def plugin_context(self):
         """Pushes the plugin on the plugin context stack."""
-        _plugin_ctx_stack.push(self)
+        token = _plugin_ctx_stack.push(self)
         try:
             yield
         finally:
-            assert _plugin_ctx_stack.pop() is self, 'Popped wrong plugin'
+            assert _plugin_ctx_stack.pop(token) is self, 'Popped wrong plugin'
 
     def connect(self, signal, receiver, **connect_kwargs):
         connect_kwargs['weak'] = False
-        signal.connect(wrap_in_plugin_context(self, receiver), **connect_kwargs)
+        signal.connect(wrap_in_plugin_context(self, receiver, skippable=True), **connect_kwargs)
 
     def __repr__(self):
         return '<{}({}) bound to {}>'.format(type(self).__name__, self.name, self.app)
@@ -0,0 +1,136 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import sys
+import threading
+from collections import Counter
+
+from .globals import _plugin_ctx_stack
+
+
+def _format_frame(frame):
+    return '{}:{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+
+class PluginProfiler:
+    """Sampling profiler attributing time to the active plugins.
+
+    While running, a background thread periodically records the stack
+    of every other thread together with the plugin that thread is
+    currently running code for, i.e. its :data:`~flask_pluginengine.current_plugin`.
+    For threads running multiple asyncio tasks or greenlets, samples are
+    attributed to the plugin of the task whose plugin context changed
+    most recently, which may not be the one currently running.
+
+    The plugin of each thread is only recorded while a profiler is
+    running, so code which already was in a plugin context when the
+    profiler was started is attributed to that plugin once its plugin
+    context changes (e.g. on the next request or hook call).
+
+    Since all threads are sampled, idle threads (e.g. those waiting
+    for requests) are counted as not running code for any plugin.
+
+    :param interval: The number of seconds between two samples
+    :param max_depth: The maximum number of frames recorded per sample
+    """
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._samples = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start sampling in a background thread."""
+        if self._thread is not None:
+            raise RuntimeError('Profiler is already running')
+        self._stop_event.clear()
+        _plugin_ctx_stack.start_tracking()
+        self._thread = threading.Thread(target=self._run, name='pluginengine-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        if self._thread is None:
+            raise RuntimeError('Profiler is not running')
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        _plugin_ctx_stack.stop_tracking()
+
+    def reset(self):
+        """Discard all samples."""
+        with self._lock:
+            self._samples.clear()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            self.sample(exclude=(own_ident,))
+
+    def sample(self, exclude=()):
+        """Record one sample of all threads.
+
+        :param exclude: Identifiers of threads which are not sampled
+        """
+        samples = []
+        thread_plugins = _plugin_ctx_stack.thread_plugins
+        for ident, frame in sys._current_frames().items():
+            if ident in exclude:
+                continue
+            plugin = thread_plugins.get(ident)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(_format_frame(frame))
+                frame = frame.f_back
+            name = plugin.name if plugin is not None else None
+            samples.append((name, tuple(reversed(stack))))
+        with self._lock:
+            self._samples.update(samples)
+
+    def get_stats(self):
+        """Get the number of samples per plugin.
+
+        :return: dict mapping plugin names to sample counts; samples of
+                 code not running for any plugin use ``None`` as the key
+        """
+        stats = Counter()
+        with self._lock:
+            for (name, stack), count in self._samples.items():
+                stats[name] += count
+        return dict(stats)
+
+    def export_collapsed(self):
+        """Export the samples as collapsed stacks.
+
+        Each line contains the plugin (``plugin:<name>`` or ``core``)
+        followed by the stack frames, separated by semicolons, and the
+        number of samples.  This is the format used by tools such as
+        ``flamegraph.pl`` or speedscope.
+        """
+        with self._lock:
+            items = sorted(self._samples.items(), key=lambda x: (x[0][0] or '', x[0][1]))
+        lines = []
+        for (name, stack), count in items:
+            root = f'plugin:{name}' if name is not None else 'core'
+            lines.append('{} {}'.format(';'.join((root,) + stack), count))
+        return '\n'.join(lines)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def __repr__(self):
+        return f'<PluginProfiler(interval={self.interval}, running={self.running})>'
@@ -0,0 +1,36 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+"""Pytest fixtures for testing applications using plugins.
+
+Enable them by adding ``pytest_plugins = ('flask_pluginengine.pytest_plugin',)``
+to your top-level ``conftest.py``.
+"""
+
+import pytest
+
+from .templating import MemoryBytecodeCache
+from .testing import create_plugin_app
+
+
+@pytest.fixture(scope='session')
+def plugin_template_cache():
+    """Compiled templates shared by all apps created during the test session."""
+    return MemoryBytecodeCache()
+
+
+@pytest.fixture
+def make_plugin_app(plugin_template_cache):
+    """Factory to create an app with plugins loaded from the given classes.
+
+    See :func:`~flask_pluginengine.testing.create_plugin_app` for the
+    accepted arguments.
+    """
+    def _make_plugin_app(import_name, plugins, **kwargs):
+        kwargs.setdefault('template_cache', plugin_template_cache)
+        return create_plugin_app(import_name, plugins, **kwargs)
+
+    return _make_plugin_app
@@ -0,0 +1,196 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+import threading
+from collections import namedtuple
+
+from flask.helpers import get_root_path
+from importlib_metadata import entry_points as importlib_entry_points
+
+
+class EntryPointInfo(namedtuple('EntryPointInfo', ('name', 'package_name', 'package_version', 'root_path'))):
+    """Information about a plugin which is taken from its entry point.
+
+    It is only looked up once per process for each entry point and then
+    applied to the plugin class when it is loaded for the first time.
+
+    :param name: The name of the entry point
+    :param package_name: The top-level package containing the plugin
+    :param package_version: The version of the distribution providing
+                            the entry point
+    :param root_path: The path of the module containing the plugin
+    """
+
+    __slots__ = ()
+
+
+# Entry points shared by all registries, keyed by the group and then by name.
+# Looking up entry points means scanning the metadata of every installed
+# distribution, so this is only done once per group and process.
+_entry_point_index = {}
+# Entry point information shared by all registries, keyed by the group, name and
+# value of the entry point.  Reading the version from the distribution metadata
+# and finding the path of the module are not free, and neither changes while the
+# process is running.
+_entry_point_info = {}
+_cache_lock = threading.Lock()
+
+
+def get_entry_points(group, name):
+    """Get the entry points with the given name in an entry point group.
+
+    All entry points of the group are looked up once per process.
+
+    :param group: The entry point group
+    :param name: The name of the entry points
+    :return: A list of entry points
+    """
+    try:
+        index = _entry_point_index[group]
+    except KeyError:
+        with _cache_lock:
+            if group not in _entry_point_index:
+                index = {}
+                for entry_point in importlib_entry_points(group=group):
+                    index.setdefault(entry_point.name, []).append(entry_point)
+                _entry_point_index[group] = index
+            index = _entry_point_index[group]
+    return index.get(name, [])
+
+
+def get_entry_point_info(entry_point):
+    """Get the :class:`EntryPointInfo` of an entry point.
+
+    :param entry_point: An entry point whose module has already been imported
+    """
+    key = (entry_point.group, entry_point.name, entry_point.value)
+    try:
+        return _entry_point_info[key]
+    except KeyError:
+        pass
+    with _cache_lock:
+        if key not in _entry_point_info:
+            _entry_point_info[key] = EntryPointInfo(entry_point.name, entry_point.module.split('.')[0],
+                                                    entry_point.dist.version, get_root_path(entry_point.module))
+        return _entry_point_info[key]
+
+
+def clear_entry_point_cache():
+    """Clear the entry points and entry point information cached for the process.
+
+    Call this after installing or removing plugins at runtime, so they
+    are looked up again.  Plugins which have already been resolved by a
+    :class:`PluginRegistry` are kept until :meth:`PluginRegistry.clear`
+    is called as well.
+    """
+    with _cache_lock:
+        _entry_point_index.clear()
+        _entry_point_info.clear()
+
+
+class PluginLoadError(Exception):
+    """Raised when a plugin cannot be resolved.
+
+    :param phase: The phase in which resolving the plugin failed
+                  (see :class:`~flask_pluginengine.engine.PluginLoadFailure`)
+    :param message: A human-readable description of the failure
+    """
+
+    def __init__(self, phase, message):
+        super().__init__(message)
+        self.phase = phase
+        self.message = message
+
+
+class PluginRegistry:
+    """Cache for plugins resolved from entry points.
+
+    Looking up the entry point of a plugin and importing it is done
+    only once per registry.  When creating multiple applications in the
+    same process, pass the same registry to all
+    :class:`~flask_pluginengine.PluginEngine` instances so all of them
+    can use the already-resolved plugins.  The entry points themselves
+    and the information taken from them (see :class:`EntryPointInfo`)
+    are cached for the whole process (see :func:`clear_entry_point_cache`),
+    and that information is only set on the plugin class once.
+
+    Failures are cached as well, so a plugin that could not be imported
+    will not be imported again until :meth:`clear` is called.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._initialized = set()
+        self._lock = threading.RLock()
+
+    def resolve(self, namespace, name, base_class):
+        """Get the plugin class for an entry point.
+
+        :param namespace: The entry point group
+        :param name: The name of the plugin
+        :param base_class: The class the plugin must inherit from
+        :raise PluginLoadError: if the plugin cannot be resolved
+        :return: The plugin class
+        """
+        key = (namespace, name)
+        try:
+            info, plugin_class, error = self._entries[key]
+        except KeyError:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = self._load(namespace, name)
+                info, plugin_class, error = self._entries[key]
+        if error is not None:
+            phase, message, cause = error
+            raise PluginLoadError(phase, message) from cause
+        if not issubclass(plugin_class, base_class):
+            raise PluginLoadError('subclass', f'Plugin does not inherit from {base_class.__name__}')
+        if key not in self._initialized:
+            with self._lock:
+                if key not in self._initialized:
+                    self._init_plugin_class(plugin_class, info)
+                    self._initialized.add(key)
+        return plugin_class
+
+    def clear(self):
+        """Forget all plugins resolved by this registry.
+
+        The entry points cached for the whole process are kept; use
+        :func:`clear_entry_point_cache` to clear them.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._initialized.clear()
+
+    def _load(self, namespace, name):
+        entry_points = get_entry_points(namespace, name)
+        if not entry_points:
+            return None, None, ('lookup', 'Plugin does not exist', None)
+        elif len(entry_points) > 1:
+            defs = ', '.join(ep.module for ep in entry_points)
+            return None, None, ('non-unique', f'Plugin name is not unique (defined in {defs})', None)
+        entry_point = list(entry_points)[0]
+        try:
+            plugin_class = entry_point.load()
+        except ImportError as exc:
+            return None, None, ('import', 'Could not import plugin', exc)
+        return get_entry_point_info(entry_point), plugin_class, None
+
+    def _init_plugin_class(self, plugin_class, info):
+        if plugin_class.__dict__.get('_entry_point_info') is info:
+            # already set up by another registry
+            return
+        plugin_class.package_name = info.package_name
+        plugin_class.package_version = info.package_version
+        if plugin_class.version is None:
+            plugin_class.version = info.package_version
+        plugin_class.name = info.name
+        plugin_class.root_path = info.root_path
+        plugin_class._metadata = None
+        plugin_class._entry_point_info = info
+
+    def __repr__(self):
+        return f'<PluginRegistry({len(self._entries)} entries)>'
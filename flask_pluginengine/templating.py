@@ -5,16 +5,138 @@
 # and/or modify it under the terms of the Revised BSD License.
 
 import os
+import threading
+import time
 
 from flask import current_app
 from flask.templating import Environment
 from jinja2 import FileSystemLoader, PrefixLoader, Template, TemplateNotFound
+from jinja2.bccache import Bucket, BytecodeCache
 from jinja2.compiler import CodeGenerator
 from jinja2.runtime import Context, Macro
 from jinja2.utils import internalcode
 
-from .util import (get_state, plugin_name_from_template_name, wrap_iterator_in_plugin_context,
-                   wrap_macro_in_plugin_context)
+from .util import (get_state, plugin_name_from_template_name, wrap_macro_in_plugin_context,
+                   wrap_render_func_in_plugin_context)
+
+
+class TemplateChangeTracker:
+    """Batched change detection for a template directory
+
+    Instead of checking the modification time of a template file each
+    time Jinja wants to know whether a cached template is up to date,
+    the whole directory is scanned at most once every `interval` seconds
+    and templates only compare their modification time with the result
+    of the most recent scan.  Rendering a template thus usually does not
+    touch the file system at all.
+
+    :meth:`scan` may also be called explicitly, e.g. from a file system
+    watcher, to pick up changes immediately.
+
+    :param path: The template directory to watch
+    :param interval: The minimum number of seconds between two scans
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._mtimes = {}
+        self._last_scan = time.monotonic()
+        self._lock = threading.Lock()
+
+    def scan(self):
+        """Rescan the modification times of all files in the directory."""
+        mtimes = {}
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                filename = os.path.join(root, name)
+                try:
+                    mtimes[os.path.normpath(filename)] = os.path.getmtime(filename)
+                except OSError:  # pragma: no cover
+                    # deleted while scanning
+                    pass
+        self._mtimes = mtimes
+        self._last_scan = time.monotonic()
+
+    def get_mtime(self, filename):
+        """Get the modification time of a file as of the most recent scan.
+
+        :param filename: The normalized path of the file
+        :return: The modification time or ``None`` if the file does not exist
+        """
+        if time.monotonic() - self._last_scan >= self.interval:
+            with self._lock:
+                # another thread may have scanned while we were waiting for the lock
+                if time.monotonic() - self._last_scan >= self.interval:
+                    self.scan()
+        return self._mtimes.get(filename)
+
+    def make_uptodate(self, filename, mtime):
+        """Create an `uptodate` callable for a newly loaded template.
+
+        :param filename: The path of the template file
+        :param mtime: The modification time of the file when it was loaded
+        """
+        filename = os.path.normpath(filename)
+        # the file may be newer than the most recent scan
+        self._mtimes[filename] = mtime
+
+        def uptodate():
+            return self.get_mtime(filename) == mtime
+
+        return uptodate
+
+
+class MemoryBytecodeCache(BytecodeCache):
+    """In-memory cache for compiled template code
+
+    Unlike Jinja's own template cache, which belongs to a single
+    environment, this cache can be shared by the environments of multiple
+    applications in the same process so each template only needs to be
+    compiled once.  Templates are recompiled if their source changes.
+
+    The key of a cached template includes the environment settings which
+    affect the generated code, but the environments sharing a cache should
+    still be configured the same way (e.g. regarding filters and tests).
+    """
+
+    def __init__(self):
+        self._cache = {}
+
+    def get_bucket(self, environment, name, filename, source):
+        key = (self._get_environment_key(environment, name), self.get_cache_key(name, filename))
+        bucket = Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+    def _get_environment_key(self, environment, name):
+        autoescape = environment.autoescape(name) if callable(environment.autoescape) else environment.autoescape
+        return (type(environment), environment.code_generator_class, tuple(sorted(environment.extensions)),
+                environment.block_start_string, environment.block_end_string,
+                environment.variable_start_string, environment.variable_end_string,
+                environment.comment_start_string, environment.comment_end_string,
+                environment.line_statement_prefix, environment.line_comment_prefix,
+                environment.trim_blocks, environment.lstrip_blocks, environment.newline_sequence,
+                environment.keep_trailing_newline, environment.optimized, environment.finalize,
+                environment.is_async, autoescape)
+
+    def load_bytecode(self, bucket):
+        try:
+            checksum, code = self._cache[bucket.key]
+        except KeyError:
+            return
+        if checksum == bucket.checksum:
+            bucket.code = code
+
+    def dump_bytecode(self, bucket):
+        self._cache[bucket.key] = (bucket.checksum, bucket.code)
+
+    def clear(self):
+        self._cache.clear()
+
+
+#: Compiled templates shared by all applications using ``PLUGINENGINE_SHARE_TEMPLATES``
+shared_template_cache = MemoryBytecodeCache()
 
 
 class PrefixIgnoringFileSystemLoader(FileSystemLoader):
@@ -22,11 +144,23 @@ class PrefixIgnoringFileSystemLoader(FileSystemLoader):
 
     The prefix is preserved in the template name but not when actually
     accessing the file system since the files there do not have prefixes.
+
+    If a :class:`TemplateChangeTracker` is provided, it is used instead
+    of checking the file's modification time each time Jinja wants to know
+    whether the template is up to date.
     """
 
+    tracker = None
+
+    def __init__(self, searchpath, tracker=None, **kwargs):
+        super().__init__(searchpath, **kwargs)
+        self.tracker = tracker
+
     def get_source(self, environment, template):
         name = template.split(':', 1)[1]
         source, filename, uptodate = super().get_source(environment, name)
+        if self.tracker is not None:
+            uptodate = self.tracker.make_uptodate(filename, os.path.getmtime(filename))
         return source, filename, uptodate
 
     def list_templates(self):  # pragma: no cover
@@ -34,21 +168,45 @@ class PrefixIgnoringFileSystemLoader(FileSystemLoader):
 
 
 class PluginPrefixLoader(PrefixLoader):
-    """Prefix loader that uses plugin names to select the load path"""
+    """Prefix loader that uses plugin names to select the load path
+
+    If ``PLUGINENGINE_TEMPLATE_RELOAD_INTERVAL`` is set, plugin template
+    directories are checked for changes at most once per that many
+    seconds instead of on every render (see :class:`TemplateChangeTracker`).
+    This is only relevant if templates are reloaded automatically.
 
-    def __init__(self, app):
+    :param app: The application using the loader.  If ``None``, the
+                plugins are looked up in the current application, which
+                allows sharing the loader between applications.
+    """
+
+    def __init__(self, app=None):
         super().__init__(None, ':')
         self.app = app
+        self._trackers = {}
+
+    def _get_app(self):
+        return self.app if self.app is not None else current_app
+
+    def _get_tracker(self, path):
+        interval = self._get_app().config.get('PLUGINENGINE_TEMPLATE_RELOAD_INTERVAL')
+        if not interval:
+            return None
+        try:
+            return self._trackers[path]
+        except KeyError:
+            return self._trackers.setdefault(path, TemplateChangeTracker(path, interval))
 
     def get_loader(self, template):
         try:
             plugin_name, _ = template.split(self.delimiter, 1)
         except ValueError:
             raise TemplateNotFound(template)
-        plugin = get_state(self.app).plugin_engine.get_plugin(plugin_name)
+        plugin = get_state(self._get_app()).plugin_engine.get_plugin(plugin_name)
         if plugin is None:
             raise TemplateNotFound(template)
-        loader = PrefixIgnoringFileSystemLoader(os.path.join(plugin.root_path, 'templates'))
+        path = os.path.join(plugin.root_path, 'templates')
+        loader = PrefixIgnoringFileSystemLoader(path, tracker=self._get_tracker(path))
         return loader, template
 
     def list_templates(self):  # pragma: no cover
@@ -75,7 +233,7 @@ class PluginContextTemplate(Template):
     def root_render_func(self):
         # Wraps the root render function in the plugin context.
         # That way we get the correct context when inheritance/includes are used
-        return wrap_iterator_in_plugin_context(self.plugin, self._root_render_func)
+        return wrap_render_func_in_plugin_context(self.plugin, self._root_render_func)
 
     @root_render_func.setter
     def root_render_func(self, value):
@@ -85,11 +243,20 @@ class PluginContextTemplate(Template):
         # When creating a template module we need to wrap all macros in the plugin context
         # of the containing template in case they are called from another context
         module = super().make_module(vars, shared, locals)
+        self._wrap_module_macros(module)
+        return module
+
+    async def make_module_async(self, vars=None, shared=False, locals=None):
+        # Used instead of `make_module` when importing templates with async enabled
+        module = await super().make_module_async(vars, shared, locals)
+        self._wrap_module_macros(module)
+        return module
+
+    def _wrap_module_macros(self, module):
         for macro in module.__dict__.values():
             if not isinstance(macro, Macro):
                 continue
             wrap_macro_in_plugin_context(self.plugin, macro)
-        return module
 
 
 class PluginJinjaContext(Context):
@@ -116,9 +283,10 @@ class PluginCodeGenerator(CodeGenerator):
         super().visit_Template(node, frame)
         plugin_name = plugin_name_from_template_name(self.name)
         # Execute all blocks inside the plugin context
-        self.writeline('from flask_pluginengine.util import wrap_iterator_in_plugin_context')
+        self.writeline('from flask_pluginengine.util import wrap_render_func_in_plugin_context')
         self.writeline(
-            'blocks = {name: wrap_iterator_in_plugin_context(%r, func) for name, func in blocks.items()}' % plugin_name
+            'blocks = {name: wrap_render_func_in_plugin_context(%r, func) for name, func in blocks.items()}'
+            % plugin_name
         )
 
     def visit_CallBlock(self, *args, **kwargs):
@@ -0,0 +1,79 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+from flask.helpers import get_root_path
+
+from .engine import PluginEngine
+from .mixins import PluginFlask
+from .util import get_state
+
+
+def init_plugin_class(plugin_class, name):
+    """Set the metadata a plugin class usually gets from its entry point.
+
+    Attributes which have already been set (e.g. a custom `root_path`)
+    are kept.
+
+    :param plugin_class: A plugin class
+    :param name: The name of the plugin
+    """
+    plugin_class.name = name
+    if plugin_class.package_name is None:
+        plugin_class.package_name = plugin_class.__module__.split('.')[0]
+    if plugin_class.root_path is None:
+        plugin_class.root_path = get_root_path(plugin_class.__module__)
+    plugin_class._metadata = None
+    plugin_class._entry_point_info = None
+
+
+def load_plugin_classes(engine, app, plugins, skip_failed=True, parallel=False):
+    """Load plugins into an application without looking up entry points.
+
+    :param engine: A :class:`~flask_pluginengine.PluginEngine`
+    :param app: A Flask application which has been registered with
+                the plugin engine
+    :param plugins: dict mapping plugin names to plugin classes
+    :param skip_failed: See :meth:`~flask_pluginengine.PluginEngine.load_plugins`
+    :param parallel: See :meth:`~flask_pluginengine.PluginEngine.load_plugins`
+    :return: True if all plugins could have been loaded, False otherwise.
+    """
+    state = get_state(app)
+    if state.plugins_loaded:
+        raise RuntimeError(f'Plugins already loaded for {state.app}')
+    state.plugins_loaded = True
+    for name, plugin_class in plugins.items():
+        init_plugin_class(plugin_class, name)
+    app.config['PLUGINENGINE_PLUGINS'] = list(plugins)
+    return engine._load_plugin_classes(state, dict(plugins), skip_failed, parallel)
+
+
+def create_plugin_app(import_name, plugins, config=None, engine=None, template_cache=None, app_class=PluginFlask,
+                      **kwargs):
+    """Create an application with the given plugins loaded.
+
+    :param import_name: The import name of the application
+    :param plugins: dict mapping plugin names to plugin classes
+    :param config: dict with additional config settings for the app
+    :param engine: The :class:`~flask_pluginengine.PluginEngine` to use.
+                   By default a new one is created.
+    :param template_cache: A :class:`~flask_pluginengine.templating.MemoryBytecodeCache`
+                           to share compiled templates with other apps
+    :param app_class: The application class to use
+    :param kwargs: Additional arguments passed to the application class
+    :return: The new application
+    """
+    app = app_class(import_name, **kwargs)
+    app.config['TESTING'] = True
+    app.config['PLUGINENGINE_NAMESPACE'] = 'flask_pluginengine.testing'
+    app.config.update(config or {})
+    if template_cache is not None:
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=template_cache)
+    if engine is None:
+        engine = PluginEngine()
+    engine.init_app(app)
+    if not load_plugin_classes(engine, app, plugins):
+        raise RuntimeError(f'Could not load plugins: {", ".join(sorted(engine.get_failed_plugins(app)))}')
+    return app
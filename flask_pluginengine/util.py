@@ -7,11 +7,13 @@
 import sys
 from contextlib import contextmanager
 from functools import wraps
-from types import FunctionType
+from inspect import isasyncgenfunction, iscoroutinefunction
+from types import FunctionType, MethodType
 
 from flask import current_app
 from jinja2.utils import internalcode
 
+from .budgets import call_with_budget
 from .globals import _plugin_ctx_stack
 
 
@@ -33,7 +35,25 @@ def resolve_dependencies(plugins):
 
     :param plugins: dict mapping plugin names to plugin classes
     """
-    plugins_deps = {name: (cls.required_plugins, cls.used_plugins) for name, cls in plugins.items()}
+    for level in resolve_dependency_levels(plugins):
+        yield from level
+
+
+def resolve_dependency_levels(plugins):
+    """Resolve dependencies between plugins and group them in levels.
+
+    Each level is a list of ``(name, cls)`` tuples containing plugins
+    which only depend on plugins from previous levels, so all plugins
+    within the same level can be loaded independently from each other.
+    Soft dependencies forming a cycle cannot be met; in that case all
+    remaining plugins whose hard dependencies are met are put on the
+    same level, possibly together with the plugins they soft-depend on.
+
+    :param plugins: dict mapping plugin names to plugin classes
+    """
+    # soft dependencies on plugins that are not available can never be met
+    plugins_deps = {name: (cls.required_plugins, frozenset(cls.used_plugins & plugins.keys()))
+                    for name, cls in plugins.items()}
     resolved_deps = set()
     while plugins_deps:
         # Get plugins with both hard and soft dependencies being met
@@ -46,8 +66,45 @@ def resolve_dependencies(plugins):
             raise Exception('Could not resolve dependencies between plugins')
         resolved_deps |= ready
         for name in ready:
-            yield name, plugins[name]
             del plugins_deps[name]
+        yield [(name, plugins[name]) for name in ready]
+
+
+def find_unresolvable_plugins(plugins):
+    """Find plugins whose hard dependencies cannot be satisfied.
+
+    This includes plugins depending on plugins which are not available
+    (or which are unresolvable themselves) and plugins with circular
+    dependencies.
+
+    :param plugins: dict mapping plugin names to plugin classes
+    :return: dict mapping the names of unresolvable plugins to the
+             names of the dependencies which could not be satisfied
+    """
+    available = set(plugins)
+    unresolvable = {}
+    changed = True
+    while changed:
+        changed = False
+        for name in sorted(available):
+            missing = plugins[name].required_plugins - available
+            if missing:
+                unresolvable[name] = frozenset(missing)
+                available.discard(name)
+                changed = True
+    # anything that cannot be resolved now is part of (or depends on) a cycle
+    remaining = {name: plugins[name].required_plugins for name in available}
+    resolved = set()
+    while remaining:
+        ready = {name for name, deps in remaining.items() if deps <= resolved}
+        if not ready:
+            break
+        resolved |= ready
+        for name in ready:
+            del remaining[name]
+    for name, deps in remaining.items():
+        unresolvable[name] = frozenset(deps - resolved)
+    return unresolvable
 
 
 @contextmanager
@@ -59,11 +116,11 @@ def plugin_context(plugin):
     """
     if plugin is None:
         # Explicitly push a None plugin to disable an existing plugin context
-        _plugin_ctx_stack.push(None)
+        token = _plugin_ctx_stack.push(None)
         try:
             yield
         finally:
-            assert _plugin_ctx_stack.pop() is None, 'Popped wrong plugin'
+            assert _plugin_ctx_stack.pop(token) is None, 'Popped wrong plugin'
     else:
         with plugin.instance.plugin_context():
             yield
@@ -71,6 +128,9 @@ def plugin_context(plugin):
 
 class equality_preserving_decorator:
     """Decorator which is considered equal with the original function"""
+
+    __slots__ = ('orig_func', 'wrapper')
+
     def __init__(self, orig_func):
         self.orig_func = orig_func
         self.wrapper = None
@@ -107,42 +167,200 @@ def plugin_name_from_template_name(name):
 
 
 def wrap_iterator_in_plugin_context(plugin, gen_or_func):
-    """Run an iterator inside a plugin context"""
+    """Run an iterator inside a plugin context
+
+    Both regular and asynchronous iterators are supported.  When passing
+    a function, it is wrapped so the iterator it returns runs inside the
+    plugin context.
+    """
     # Heavily based on Flask's stream_with_context
-    try:
-        gen = iter(gen_or_func)
-    except TypeError:
-        @equality_preserving_decorator(gen_or_func)
-        def decorator(*args, **kwargs):
-            return wrap_iterator_in_plugin_context(plugin, gen_or_func(*args, **kwargs))
+    if hasattr(gen_or_func, '__aiter__'):
+        gen = gen_or_func.__aiter__()
+        is_async = True
+    else:
+        try:
+            gen = iter(gen_or_func)
+        except TypeError:
+            @equality_preserving_decorator(gen_or_func)
+            def decorator(*args, **kwargs):
+                return wrap_iterator_in_plugin_context(plugin, gen_or_func(*args, **kwargs))
 
-        return decorator
+            return decorator
+        is_async = False
 
     if plugin is not None and isinstance(plugin, str):
         plugin = get_state(current_app).plugin_engine.get_plugin(plugin)
 
+    # The plugin is only pushed while the iterator is being advanced, so it does
+    # not leak into the code consuming the iterator (context variables are shared
+    # with the caller of a generator).  Between the steps the iterator keeps its
+    # own plugin context stack, based on the one active when it was created, so
+    # it can be consumed after the caller's plugin context has been popped.
+    # Other context variables are not touched, so e.g. Flask's stream_with_context
+    # can still push and pop the request context while the iterator is consumed.
+    stack = _plugin_ctx_stack.derive(plugin.instance if plugin is not None else None)
+
+    if is_async:
+        @internalcode
+        async def async_generator():
+            async for item in gen:
+                yield item
+
+        return _AsyncPluginContextIterator(stack, async_generator())
+
     @internalcode
     def generator():
-        with plugin_context(plugin):
-            # Dummy sentinel.  Has to be inside the context block or we're
-            # not actually keeping the context around.
-            yield None
+        yield from gen
+
+    return _PluginContextIterator(stack, generator())
+
+
+def wrap_render_func_in_plugin_context(plugin, func):
+    """Wrap a render function of a template so it runs inside a plugin context
+
+    This is used for the root render function and the blocks of templates.
+    Unlike :func:`wrap_iterator_in_plugin_context` the iterator does not
+    get its own plugin context stack, as these iterators are always
+    consumed completely by the template being rendered; the plugin is
+    simply pushed once per iterator.
+
+    :param plugin: A plugin instance, the name of a plugin or ``None``
+                   to run the function outside any plugin context
+    :param func: A (synchronous or asynchronous) generator function
+    """
+    if isasyncgenfunction(func):
+        @equality_preserving_decorator(func)
+        def async_decorator(*args, **kwargs):
+            return _render_async_in_plugin_context(_resolve_plugin(plugin), func(*args, **kwargs))
+
+        return async_decorator
+
+    @equality_preserving_decorator(func)
+    def decorator(*args, **kwargs):
+        return _render_in_plugin_context(_resolve_plugin(plugin), func(*args, **kwargs))
+
+    return decorator
+
+
+def _resolve_plugin(plugin):
+    if isinstance(plugin, str):
+        return get_state(current_app).plugin_engine.get_plugin(plugin)
+    return plugin
+
+
+@internalcode
+def _render_in_plugin_context(plugin, gen):
+    token = _plugin_ctx_stack.push(plugin)
+    try:
+        yield from gen
+    finally:
+        _plugin_ctx_stack.pop(token)
+
+
+@internalcode
+async def _render_async_in_plugin_context(plugin, gen):
+    token = _plugin_ctx_stack.push(plugin)
+    try:
+        async for item in gen:
+            yield item
+    finally:
+        _plugin_ctx_stack.pop(token)
+
+
+class _PluginContextIterator:
+    """Iterator advancing a generator with its own plugin context stack."""
+
+    __slots__ = ('_stack', '_gen')
+
+    def __init__(self, stack, gen):
+        self._stack = stack
+        self._gen = gen
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = _plugin_ctx_stack.activate(self._stack)
+        try:
+            return next(self._gen)
+        finally:
+            self._stack = _plugin_ctx_stack.deactivate(token)
+
+    def close(self):
+        if not self._gen.gi_running:
+            token = _plugin_ctx_stack.activate(self._stack)
+            try:
+                self._gen.close()
+            finally:
+                self._stack = _plugin_ctx_stack.deactivate(token)
+
 
-            yield from gen
+class _AsyncPluginContextIterator:
+    """Asynchronous iterator advancing an async generator with its own plugin context stack."""
 
-    # The trick is to start the generator.  Then the code execution runs until
-    # the first dummy None is yielded at which point the context was already
-    # pushed.  This item is discarded.  Then when the iteration continues the
-    # real generator is executed.
-    wrapped_g = generator()
-    next(wrapped_g)
-    return wrapped_g
+    __slots__ = ('_stack', '_gen')
+
+    def __init__(self, stack, gen):
+        self._stack = stack
+        self._gen = gen
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return _PluginContextAwaitable(self, self._gen.__anext__())
+
+    def aclose(self):
+        return _PluginContextAwaitable(self, self._gen.aclose())
+
+
+class _PluginContextAwaitable:
+    """Awaitable running each step of another awaitable with the plugin context stack of an iterator."""
+
+    __slots__ = ('_iterator', '_awaitable')
+
+    def __init__(self, iterator, awaitable):
+        self._iterator = iterator
+        self._awaitable = awaitable
+
+    def __await__(self):
+        iterator = self._iterator
+        awaitable = self._awaitable
+        value = exc = None
+        while True:
+            token = _plugin_ctx_stack.activate(iterator._stack)
+            try:
+                if exc is None:
+                    result = awaitable.send(value)
+                else:
+                    result = awaitable.throw(exc)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                iterator._stack = _plugin_ctx_stack.deactivate(token)
+            try:
+                value = yield result
+                exc = None
+            except BaseException as e:
+                value = None
+                exc = e
 
 
 def wrap_macro_in_plugin_context(plugin, macro):
     """Wrap a macro inside a plugin context"""
     func = macro._func
 
+    if iscoroutinefunction(func):
+        # macros of templates in an environment with async enabled
+        @internalcode
+        @wraps(func)
+        async def async_decorator(*args, **kwargs):
+            with plugin_context(plugin):
+                return await func(*args, **kwargs)
+
+        macro._func = async_decorator
+        return
+
     @internalcode
     @wraps(func)
     def decorator(*args, **kwargs):
@@ -160,7 +378,7 @@ class classproperty(property):
 def make_hashable(obj):
     """Make an object containing dicts and lists hashable."""
     if isinstance(obj, list):
-        return tuple(obj)
+        return tuple(make_hashable(x) for x in obj)
     elif isinstance(obj, dict):
         return frozenset((k, make_hashable(v)) for k, v in obj.items())
     return obj
@@ -180,16 +398,75 @@ def memoize(obj):
     return memoizer
 
 
-@memoize
-def wrap_in_plugin_context(plugin, func):
+def wrap_in_plugin_context(plugin, func, skippable=False):
+    """Wrap a function so it always runs in the given plugin context.
+
+    If the plugin has a :class:`~flask_pluginengine.budgets.PluginBudget`,
+    it is enforced on each call.
+
+    There is only one wrapper for each plugin and function, so e.g. a
+    signal receiver connected using :meth:`~flask_pluginengine.Plugin.connect`
+    can be disconnected using the wrapper returned by this function.
+
+    :param plugin: Plugin instance
+    :param func: The function to wrap
+    :param skippable: Whether calls may be skipped if the plugin exceeded
+                      its budget too often in the current request.  This
+                      applies to the shared wrapper, so it stays skippable
+                      once it has been requested as such.
+    """
     assert plugin is not None
+    rv = _get_plugin_context_function(plugin, func)
+    if skippable:
+        rv.skippable = True
+    return rv
 
-    @wraps(func)
-    def wrapped(*args, **kwargs):
+
+@memoize
+def _get_plugin_context_function(plugin, func):
+    return _PluginContextFunction(plugin, func)
+
+
+class _PluginContextFunction:
+    # Function running another function in the context of a plugin.  This is
+    # used instead of a closure since there may be many thousands of them and
+    # a closure with a copy of the function's `__dict__` (as created by
+    # `functools.wraps`) uses a lot more memory.  Any attributes of the wrapped
+    # function are still available on the wrapper.
+
+    __slots__ = ('plugin', 'skippable', '__wrapped__')
+
+    def __init__(self, plugin, func):
+        self.plugin = plugin
+        self.skippable = False
+        self.__wrapped__ = func
+
+    def __call__(self, *args, **kwargs):
+        plugin = self.plugin
+        if plugin.budget is not None:
+            return call_with_budget(plugin, self.__wrapped__, args, kwargs, self.skippable)
         with plugin.plugin_context():
-            return func(*args, **kwargs)
+            return self.__wrapped__(*args, **kwargs)
 
-    return wrapped
+    def __get__(self, obj, objtype=None):
+        # behave like a function when used as a method
+        if obj is None:
+            return self
+        return MethodType(self, obj)
+
+    def __getattr__(self, name):
+        # called for anything that is not a slot, e.g. `__name__`, and for
+        # slots which are not set yet, e.g. while the wrapper is being copied
+        if name == '__wrapped__':
+            raise AttributeError(name)
+        return getattr(self.__wrapped__, name)
+
+    @property
+    def __doc__(self):
+        return self.__wrapped__.__doc__
+
+    def __repr__(self):
+        return f'<{self.__wrapped__!r} in plugin context {self.plugin.name}>'
 
 
 def with_plugin_context(plugin):
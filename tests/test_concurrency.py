@@ -0,0 +1,296 @@
+# This file is part of Flask-PluginEngine.
+# Copyright (C) 2014-2021 CERN
+#
+# Flask-PluginEngine is free software; you can redistribute it
+# and/or modify it under the terms of the Revised BSD License.
+
+"""Stress tests checking that plugin contexts never leak between workers."""
+
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from flask import Response, render_template
+
+from flask_pluginengine import (Plugin, PluginBlueprint, current_plugin, get_current_plugin, plugin_context,
+                                render_plugin_template, stream_plugin_template)
+from flask_pluginengine.testing import create_plugin_app
+from flask_pluginengine.util import get_state, wrap_iterator_in_plugin_context
+
+
+WORKERS = 16
+PLUGINS = ('alpha', 'beta', 'gamma')
+
+
+def _whereami():
+    return current_plugin.name if current_plugin else 'core'
+
+
+async def _whereami_async():
+    await asyncio.sleep(0)
+    return _whereami()
+
+
+def _pause():
+    # give other threads a chance to run in the middle of rendering
+    time.sleep(0)
+    return ''
+
+
+class WorkerPlugin(Plugin):
+    """Worker"""
+
+    def init(self):
+        bp = PluginBlueprint(self.name, __name__)
+        bp.add_url_rule('/view', 'view', _view)
+        bp.add_url_rule('/stream', 'stream', _stream)
+        self.app.register_blueprint(bp, url_prefix=f'/{self.name}')
+
+
+def _view():
+    plugin = get_current_plugin()
+    _pause()
+    assert get_current_plugin() is plugin
+    return f'{_whereami()}|{render_plugin_template("worker.txt")}|{render_template("worker.txt")}'
+
+
+def _stream():
+    # the template is rendered while the response is sent, after the view returned
+    return Response(stream_plugin_template('worker.txt'))
+
+
+def _core_view():
+    return f'{_whereami()}|{render_template("worker.txt")}'
+
+
+def _make_app(tmp_path, enable_async=False):
+    plugins = {}
+    for name in PLUGINS:
+        root = tmp_path / name
+        (root / 'templates').mkdir(parents=True)
+        (root / 'templates' / 'worker.txt').write_text(
+            '{% for i in range(5) %}{{ pause() }}{{ whereami() }}\n{% endfor %}'
+        )
+        (root / 'templates' / 'worker_async.txt').write_text(
+            '{% for i in range(5) %}{{ whereami_async() }}\n{% endfor %}'
+        )
+        plugins[name] = type(f'{name.title()}Plugin', (WorkerPlugin,), {'root_path': str(root)})
+    core_templates = tmp_path / 'core'
+    core_templates.mkdir()
+    (core_templates / 'worker.txt').write_text('{{ whereami() }}')
+    app = create_plugin_app(__name__, plugins, template_folder=str(core_templates))
+    if enable_async:
+        app.jinja_options = {**app.jinja_options, 'enable_async': True}
+    app.add_template_global(_whereami, 'whereami')
+    app.add_template_global(_whereami_async, 'whereami_async')
+    app.add_template_global(_pause, 'pause')
+    app.add_url_rule('/view', 'view', _core_view)
+    return app
+
+
+@pytest.fixture
+def app(tmp_path):
+    return _make_app(tmp_path)
+
+
+@pytest.fixture
+def async_app(tmp_path):
+    return _make_app(tmp_path, enable_async=True)
+
+
+def _expected_view(name):
+    if name == 'core':
+        return 'core|core'
+    return '{}|{}|core'.format(name, f'{name}\n' * 5)
+
+
+def test_threaded_views(app):
+    """
+    Check that concurrent requests always run in the context of the plugin owning the view
+    """
+    client = app.test_client()
+    names = ('core',) + PLUGINS
+
+    def _request(name):
+        url = '/view' if name == 'core' else f'/{name}/view'
+        return name, client.get(url).get_data(as_text=True)
+
+    with ThreadPoolExecutor(WORKERS) as executor:
+        results = list(executor.map(_request, itertools.islice(itertools.cycle(names), 2000)))
+    for name, data in results:
+        assert data == _expected_view(name)
+
+
+def test_threaded_streamed_responses(app):
+    """
+    Check that templates streamed by concurrent requests are rendered in the plugin context of the view
+    """
+    client = app.test_client()
+
+    def _request(name):
+        return name, client.get(f'/{name}/stream').get_data(as_text=True)
+
+    with ThreadPoolExecutor(WORKERS) as executor:
+        results = list(executor.map(_request, itertools.islice(itertools.cycle(PLUGINS), 2000)))
+    for name, data in results:
+        assert data == f'{name}\n' * 5
+
+
+def test_threaded_streams(app):
+    """
+    Check that interleaved template streams in many threads never leak their plugin context
+    """
+    plugins = [get_state(app).plugins[name] for name in PLUGINS]
+    barrier = threading.Barrier(WORKERS)
+
+    def _worker(n):
+        barrier.wait(5)
+        with app.app_context():
+            for i in range(50):
+                streams = []
+                for plugin in plugins:
+                    with plugin.plugin_context():
+                        streams.append((plugin.name, stream_plugin_template('worker.txt')))
+                assert get_current_plugin() is None
+                # consume the streams in lockstep so their steps are interleaved
+                data = {name: '' for name, __ in streams}
+                for chunks in itertools.zip_longest(*(stream for __, stream in streams), fillvalue=''):
+                    for (name, __), chunk in zip(streams, chunks):
+                        data[name] += chunk
+                        assert get_current_plugin() is None
+                assert data == {name: f'{name}\n' * 5 for name in PLUGINS}
+        return n
+
+    with ThreadPoolExecutor(WORKERS) as executor:
+        assert sorted(executor.map(_worker, range(WORKERS))) == list(range(WORKERS))
+
+
+def test_threaded_stream_consumed_in_other_thread(app):
+    """
+    Check that a stream created in one thread can be consumed in another one
+    """
+    plugin = get_state(app).plugins['alpha']
+    with app.app_context(), plugin.plugin_context():
+        streams = [stream_plugin_template('worker.txt') for __ in range(200)]
+
+    def _consume(stream):
+        rv = ''.join(stream)
+        assert get_current_plugin() is None
+        return rv
+
+    with ThreadPoolExecutor(WORKERS) as executor:
+        assert set(executor.map(_consume, streams)) == {'alpha\n' * 5}
+
+
+def test_asyncio_renders(async_app):
+    """
+    Check that the plugin context is kept per task across awaits in thousands of concurrent renders
+    """
+    state = get_state(async_app)
+
+    async def _render(name):
+        plugin = state.plugins[name]
+        with plugin_context(plugin):
+            template = async_app.jinja_env.get_template(f'{name}:worker_async.txt')
+            rv = await template.render_async()
+            assert get_current_plugin() is plugin
+        assert get_current_plugin() is None
+        return name, rv
+
+    async def _iterate(name):
+        plugin = state.plugins[name]
+
+        async def _gen():
+            for i in range(5):
+                await asyncio.sleep(0)
+                yield _whereami()
+
+        items = [item async for item in wrap_iterator_in_plugin_context(plugin, _gen())]
+        assert get_current_plugin() is None
+        return name, ''.join(f'{item}\n' for item in items)
+
+    async def _main():
+        coros = [func(name) for __ in range(500) for func, name in itertools.product((_render, _iterate), PLUGINS)]
+        return await asyncio.gather(*coros)
+
+    with async_app.app_context():
+        results = asyncio.run(_main())
+    assert len(results) == 3000
+    for name, data in results:
+        assert data == f'{name}\n' * 5
+
+
+def test_greenlets(app):
+    """
+    Check that greenlets switching in the middle of a plugin context do not see each other's plugin
+    """
+    greenlet = pytest.importorskip('greenlet')
+    plugins = [get_state(app).plugins[name] for name in PLUGINS]
+    main = greenlet.getcurrent()
+    errors = []
+
+    def _worker(plugin):
+        try:
+            for i in range(20):
+                with plugin.plugin_context():
+                    main.switch()
+                    assert get_current_plugin() is plugin
+                    with plugin_context(None):
+                        main.switch()
+                        assert get_current_plugin() is None
+                    assert get_current_plugin() is plugin
+                assert get_current_plugin() is None
+                main.switch()
+        except AssertionError as exc:  # pragma: no cover
+            errors.append(exc)
+
+    workers = [greenlet.greenlet(_worker) for __ in range(1000)]
+    args = itertools.cycle(plugins)
+    pending = {worker: next(args) for worker in workers}
+    while pending:
+        for worker, plugin in list(pending.items()):
+            worker.switch(plugin)
+            assert get_current_plugin() is None
+            if worker.dead:
+                del pending[worker]
+    assert not errors
+
+
+def test_gevent_views(app):
+    """
+    Check that concurrent requests handled by gevent greenlets do not leak their plugin context
+    """
+    gevent = pytest.importorskip('gevent')
+    client = app.test_client()
+    # switch to other greenlets in the middle of rendering
+    app.jinja_env.globals['pause'] = lambda: gevent.sleep(0) or ''
+
+    def _request(name):
+        return name, client.get(f'/{name}/view').get_data(as_text=True)
+
+    jobs = [gevent.spawn(_request, name) for name in itertools.islice(itertools.cycle(PLUGINS), 2000)]
+    gevent.joinall(jobs, raise_error=True)
+    for job in jobs:
+        name, data = job.value
+        assert data == _expected_view(name)
+
+
+def test_gevent_streamed_responses(app):
+    """
+    Check that templates streamed by requests handled by gevent greenlets do not leak their plugin context
+    """
+    gevent = pytest.importorskip('gevent')
+    client = app.test_client()
+    app.jinja_env.globals['pause'] = lambda: gevent.sleep(0) or ''
+
+    def _request(name):
+        return name, client.get(f'/{name}/stream').get_data(as_text=True)
+
+    jobs = [gevent.spawn(_request, name) for name in itertools.islice(itertools.cycle(PLUGINS), 2000)]
+    gevent.joinall(jobs, raise_error=True)
+    for job in jobs:
+        name, data = job.value
+        assert data == f'{name}\n' * 5
@@ -4,18 +4,43 @@
 # Flask-PluginEngine is free software; you can redistribute it
 # and/or modify it under the terms of the Revised BSD License.
 
+import asyncio
+import copy
+import hashlib
+import json
 import os
 import re
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
 from dataclasses import dataclass
 
 import pytest
+from blinker import Namespace
 from importlib_metadata import EntryPoint
-from jinja2 import TemplateNotFound
-from flask import render_template, Flask
+from jinja2 import Environment, TemplateNotFound
+from werkzeug.routing import Rule
+from flask import Response, render_template, request, template_rendered, url_for, Flask
 
 from flask_pluginengine import (PluginEngine, plugins_loaded, Plugin, render_plugin_template, current_plugin,
-                                plugin_context, PluginFlask)
-from flask_pluginengine.templating import PrefixIgnoringFileSystemLoader
+                                plugin_context, PluginBlueprint, PluginFlask, PluginRegistry, depends,
+                                get_current_plugin, hook, stream_plugin_template, url_for_plugin_static, uses,
+                                with_plugin_context)
+from flask_pluginengine.budgets import PluginBudget
+from flask_pluginengine.mixins import LazyBuilderRule
+from flask_pluginengine.caching import FragmentCache, FragmentCacheExtension, LRUFragmentCache, get_fragment_cache
+from flask_pluginengine.profiler import PluginProfiler
+from flask_pluginengine.registry import clear_entry_point_cache
+from flask_pluginengine.globals import _plugin_ctx_stack
+from flask_pluginengine.templating import (MemoryBytecodeCache, PluginEnvironment, PrefixIgnoringFileSystemLoader,
+                                           TemplateChangeTracker, shared_template_cache)
+from flask_pluginengine.testing import create_plugin_app, load_plugin_classes
+from flask_pluginengine.util import get_state, wrap_in_plugin_context, wrap_iterator_in_plugin_context
+
+
+pytest_plugins = ('flask_pluginengine.pytest_plugin',)
 
 
 class EspressoModule(Plugin):
@@ -46,6 +71,58 @@ class NonDescriptivePlugin(Plugin):
     """NonDescriptivePlugin"""
 
 
+class BarrierPlugin(Plugin):
+    """BarrierPlugin
+
+    I only finish initializing once my sibling started initializing
+    """
+    barrier = None
+
+    def init(self):
+        self.barrier.wait(timeout=5)
+        self.context_plugin = current_plugin._get_current_object()
+
+
+class BarrierSiblingPlugin(BarrierPlugin):
+    """BarrierSiblingPlugin"""
+
+
+@depends('barrier', 'barriersibling')
+class BarrierDependentPlugin(Plugin):
+    """BarrierDependentPlugin"""
+
+    def init(self):
+        assert self.plugin_engine.has_plugin('barrier')
+        assert self.plugin_engine.has_plugin('barriersibling')
+
+
+@depends('importfail')
+class BrokenDependencyPlugin(Plugin):
+    """BrokenDependencyPlugin"""
+
+
+@depends('brokendep')
+class IndirectBrokenDependencyPlugin(Plugin):
+    """IndirectBrokenDependencyPlugin"""
+
+
+@depends('cycleb')
+class CycleAPlugin(Plugin):
+    """CycleAPlugin"""
+
+
+@depends('cyclea')
+class CycleBPlugin(Plugin):
+    """CycleBPlugin"""
+
+
+class FailingInitPlugin(Plugin):
+    """FailingInitPlugin"""
+
+    def init(self):
+        raise ValueError('init failed')
+
+
 class MockEntryPoint(EntryPoint):
     def load(self, *args, **kwargs):
         if self.name == 'importfail':
@@ -56,6 +133,22 @@ class MockEntryPoint(EntryPoint):
             return OtherVersionPlugin
         elif self.name == 'nondescriptive':
             return NonDescriptivePlugin
+        elif self.name == 'barrier':
+            return BarrierPlugin
+        elif self.name == 'barriersibling':
+            return BarrierSiblingPlugin
+        elif self.name == 'barrierdependent':
+            return BarrierDependentPlugin
+        elif self.name == 'failinginit':
+            return FailingInitPlugin
+        elif self.name == 'brokendep':
+            return BrokenDependencyPlugin
+        elif self.name == 'indirectbrokendep':
+            return IndirectBrokenDependencyPlugin
+        elif self.name == 'cyclea':
+            return CycleAPlugin
+        elif self.name == 'cycleb':
+            return CycleBPlugin
         else:
             return EspressoModule
 
@@ -70,8 +163,10 @@ def mock_entry_point(name, value):
 
 
 @pytest.fixture
-def flask_app():
+def flask_app(request):
     app = PluginFlask(__name__, template_folder='templates/core')
+    if getattr(request, 'param', None) == 'async':
+        app.jinja_options = {**app.jinja_options, 'enable_async': True}
     app.config['TESTING'] = True
     app.config['PLUGINENGINE_NAMESPACE'] = 'test'
     app.config['PLUGINENGINE_PLUGINS'] = ['espresso']
@@ -93,7 +188,7 @@ def engine(flask_app):
 
 @pytest.fixture
 def mock_entry_points(monkeypatch):
-    from flask_pluginengine import engine as engine_mod
+    from flask_pluginengine import registry as registry_mod
 
     MOCK_EPS = {
         'test': [
@@ -102,14 +197,26 @@ def mock_entry_points(monkeypatch):
             mock_entry_point('nondescriptive', 'test.plugin'),
             mock_entry_point('double', 'double'), mock_entry_point('double', 'double'),
             mock_entry_point('importfail', 'test.importfail'),
-            mock_entry_point('imposter', 'test.imposter')
+            mock_entry_point('imposter', 'test.imposter'),
+            mock_entry_point('barrier', 'test.barrier'),
+            mock_entry_point('barriersibling', 'test.barrier'),
+            mock_entry_point('barrierdependent', 'test.barrier'),
+            mock_entry_point('failinginit', 'test.failinginit'),
+            mock_entry_point('brokendep', 'test.deps'),
+            mock_entry_point('indirectbrokendep', 'test.deps'),
+            mock_entry_point('cyclea', 'test.deps'),
+            mock_entry_point('cycleb', 'test.deps'),
         ]
     }
 
-    def _mock_entry_points(*, group, name):
-        return [ep for ep in MOCK_EPS[group] if ep.name == name]
+    def _mock_entry_points(*, group):
+        lookups.append(group)
+        return MOCK_EPS[group]
 
-    monkeypatch.setattr(engine_mod, 'importlib_entry_points', _mock_entry_points)
+    lookups = []
+    monkeypatch.setattr(registry_mod, 'importlib_entry_points', _mock_entry_points)
+    monkeypatch.setattr(registry_mod, '_entry_point_index', {})
+    return lookups
 
 
 @pytest.fixture
@@ -178,6 +285,42 @@ def test_load(flask_app, engine):
         assert plugin.package_version == '1.2.3'
 
 
+@pytest.mark.usefixtures('mock_entry_points')
+def test_metadata(flask_app, engine, monkeypatch):
+    flask_app.config['PLUGINENGINE_PLUGINS'] = ['otherversion']
+    engine.load_plugins(flask_app)
+    metadata = OtherVersionPlugin.metadata
+    assert metadata.name == 'otherversion'
+    assert metadata.title == 'OtherVersionPlugin'
+    assert metadata.description == 'I am a plugin with a custom version'
+    assert metadata.version == '2.0'
+    assert metadata.package_name == 'test'
+    assert metadata.package_version == '1.2.3'
+    assert metadata.required_plugins == set()
+    assert OtherVersionPlugin.metadata is metadata
+    with flask_app.app_context():
+        assert engine.get_plugin('otherversion').metadata is metadata
+    monkeypatch.setattr(OtherVersionPlugin, 'required_plugins', frozenset())
+    monkeypatch.setattr(OtherVersionPlugin, '_metadata', metadata)
+    assert depends('foo')(OtherVersionPlugin).metadata.required_plugins == {'foo'}
+
+
+def test_title_inheritance():
+    class Parent(Plugin):
+        """Parent
+
+        I am the parent
+        """
+
+    class Child(Parent):
+        pass
+
+    assert Parent.title == 'Parent'
+    assert Child.title == ''
+    assert Child.description == 'no description available'
+    assert Plugin.title == ''
+
+
 @pytest.mark.usefixtures('mock_entry_points')
 def test_no_description(flask_app, engine):
     flask_app.config['PLUGINENGINE_PLUGINS'] = ['nondescriptive']
@@ -198,6 +341,55 @@ def test_custom_version(flask_app, engine):
         assert plugin.version == '2.0'
 
 
+@pytest.mark.usefixtures('mock_entry_points')
+def test_load_parallel(flask_app, engine, monkeypatch):
+    """
+    Plugins on the same dependency level are initialized in parallel
+    """
+    monkeypatch.setattr(BarrierPlugin, 'barrier', threading.Barrier(2))
+    flask_app.config['PLUGINENGINE_PLUGINS'] = ['barrier', 'barriersibling', 'barrierdependent']
+    assert engine.load_plugins(flask_app, parallel=True)
+    with flask_app.app_context():
+        plugins = engine.get_active_plugins()
+        assert list(plugins)[-1] == 'barrierdependent'
+        assert plugins['barrier'].context_plugin is plugins['barrier']
+        assert plugins['barriersibling'].context_plugin is plugins['barriersibling']
+
+
+@pytest.mark.usefixtures('mock_entry_points')
+def test_load_parallel_error(flask_app, engine):
+    """
+    Errors during parallel initialization are re-raised
+    """
+    flask_app.config['PLUGINENGINE_PLUGINS'] = ['espresso', 'failinginit']
+    with pytest.raises(ValueError):
+        engine.load_plugins(flask_app, parallel=2)
+    with flask_app.app_context():
+        assert list(engine.get_active_plugins()) == ['espresso']
+        failure = engine.get_failure_report()['failinginit']
+        assert failure.phase == 'init'
+        assert isinstance(failure.exception, ValueError)
+
+
+@pytest.mark.parametrize('parallel', (False, 2))
+def test_init_errors_recorded(flask_app, engine, parallel):
+    """
+    Errors during initialization are recorded as failures
+    """
+    plugins = {'ok': type('OkPlugin', (Plugin,), {'__doc__': 'Ok'}),
+               'faila': type('FailingA', (FailingInitPlugin,), {}),
+               'failb': type('FailingB', (FailingInitPlugin,), {})}
+    with pytest.raises(ValueError):
+        load_plugin_classes(engine, flask_app, plugins, parallel=parallel)
+    report = engine.get_failure_report(flask_app)
+    # without parallel initialization, loading stops at the first failure;
+    # the order of plugins within the same dependency level is arbitrary
+    assert set(report) <= {'faila', 'failb'}
+    assert len(report) == (2 if parallel else 1)
+    assert all(failure.phase == 'init' for failure in report.values())
+    assert all(str(failure.exception) == 'init failed' for failure in report.values())
+
+
 @pytest.mark.usefixtures('mock_entry_points')
 def test_fail_non_existing(flask_app, engine):
     """
@@ -269,6 +461,142 @@ def test_fail_not_subclass(flask_app, engine):
         assert len(engine.get_active_plugins()) == 0
 
 
+@pytest.mark.usefixtures('mock_entry_points')
+def test_failure_report(flask_app, engine):
+    """
+    Check that the failure report contains the reason for each failure
+    """
+    flask_app.config['PLUGINENGINE_PLUGINS'] = ['espresso', 'someotherstuff', 'double', 'importfail', 'imposter',
+                                                'brokendep', 'indirectbrokendep', 'cyclea', 'cycleb']
+    assert not engine.load_plugins(flask_app)
+    with flask_app.app_context():
+        assert list(engine.get_active_plugins()) == ['espresso']
+        report = engine.get_failure_report()
+        assert engine.get_failed_plugins() == set(report)
+        assert {name: failure.phase for name, failure in report.items()} == {
+            'someotherstuff': 'lookup',
+            'double': 'non-unique',
+            'importfail': 'import',
+            'imposter': 'subclass',
+            'brokendep': 'dependency',
+            'indirectbrokendep': 'dependency',
+            'cyclea': 'dependency',
+            'cycleb': 'dependency',
+        }
+        assert isinstance(report['importfail'].exception, ImportError)
+        assert report['imposter'].exception is None
+        assert report['brokendep'].message == 'Unresolvable dependencies: importfail'
+        assert report['cyclea'].message == 'Unresolvable dependencies: cycleb'
+        assert all(failure.elapsed >= 0 for failure in report.values())
+
+
+@pytest.mark.usefixtures('mock_entry_points')
+def test_fail_dependency_noskip(flask_app, engine):
+    """
+    Fail immediately on unresolvable dependencies if no_skip=False
+    """
+    flask_app.config['PLUGINENGINE_PLUGINS'] = ['espresso', 'cyclea', 'cycleb']
+    assert engine.load_plugins(flask_app, skip_failed=False) is False
+    with flask_app.app_context():
+        assert len(engine.get_active_plugins()) == 0
+
+
+def _make_app(plugins):
+    app = PluginFlask(__name__, template_folder='templates/core')
+    app.config['TESTING'] = True
+    app.config['PLUGINENGINE_NAMESPACE'] = 'test'
+    app.config['PLUGINENGINE_PLUGINS'] = plugins
+    return app
+
+
+def test_shared_registry(mock_entry_points, monkeypatch):
+    """
+    Check that plugins are only resolved once when sharing a registry
+    """
+    loaded = []
+    orig_load = MockEntryPoint.load
+    monkeypatch.setattr(MockEntryPoint, 'load', lambda self: loaded.append(self.name) or orig_load(self))
+    engine = PluginEngine(registry=PluginRegistry())
+    apps = [_make_app(['espresso', 'importfail']) for _ in range(3)]
+    for app in apps:
+        engine.init_app(app)
+        assert not engine.load_plugins(app)
+    assert loaded == ['espresso', 'importfail']
+    assert mock_entry_points == ['test']
+    plugins = [engine.get_plugin('espresso', app) for app in apps]
+    assert len({type(plugin) for plugin in plugins}) == 1
+    assert [plugin.app for plugin in plugins] == apps
+    report = engine.get_failure_report(apps[-1])
+    assert report['importfail'].phase == 'import'
+    assert isinstance(report['importfail'].exception, ImportError)
+    # clearing the registry keeps the entry points cached for the process
+    engine.registry.clear()
+    other_app = _make_app(['espresso'])
+    engine.init_app(other_app)
+    assert engine.load_plugins(other_app)
+    assert loaded == ['espresso', 'importfail', 'espresso']
+    assert mock_entry_points == ['test']
+    clear_entry_point_cache()
+    engine.registry.clear()
+    other_app = _make_app(['espresso'])
+    engine.init_app(other_app)
+    assert engine.load_plugins(other_app)
+    assert loaded == ['espresso', 'importfail', 'espresso', 'espresso']
+    assert mock_entry_points == ['test', 'test']
+
+
+def test_no_shared_registry(mock_entry_points, monkeypatch, engine, flask_app):
+    """
+    Check that plugins are resolved each time without a shared registry, but entry points are only looked up once
+    """
+    loaded = []
+    orig_load = MockEntryPoint.load
+    monkeypatch.setattr(MockEntryPoint, 'load', lambda self: loaded.append(self.name) or orig_load(self))
+    other_app = _make_app(['espresso'])
+    engine.init_app(other_app)
+    engine.load_plugins(flask_app)
+    engine.load_plugins(other_app)
+    assert loaded == ['espresso', 'espresso']
+    assert mock_entry_points == ['test']
+
+
+def test_entry_point_info_cached(mock_entry_points, monkeypatch, engine, flask_app):
+    """
+    Check that the information from the entry point is only looked up once per process
+    """
+    from flask_pluginengine import registry as registry_mod
+
+    root_path_lookups = []
+
+    def _get_root_path(import_name):
+        root_path_lookups.append(import_name)
+        return '/plugins/' + import_name
+
+    monkeypatch.setattr(registry_mod, 'get_root_path', _get_root_path)
+    monkeypatch.setattr(registry_mod, '_entry_point_info', {})
+    # restore the plugin class once we're done
+    for attr in ('name', 'package_name', 'package_version', 'version', 'root_path', '_metadata'):
+        monkeypatch.setattr(EspressoModule, attr, EspressoModule.__dict__.get(attr))
+    monkeypatch.setattr(EspressoModule, '_entry_point_info', None)
+    apps = [flask_app] + [_make_app(['espresso']) for _ in range(2)]
+    for app in apps:
+        engine.init_app(app)
+        assert engine.load_plugins(app)
+    assert mock_entry_points == ['test']
+    assert root_path_lookups == ['test.plugin']
+    info = EspressoModule._entry_point_info
+    assert info == ('espresso', 'test', '1.2.3', '/plugins/test.plugin')
+    assert registry_mod.get_entry_point_info(mock_entry_point('espresso', 'test.plugin')) is info
+    assert EspressoModule.root_path == '/plugins/test.plugin'
+    assert EspressoModule.package_version == '1.2.3'
+    PluginRegistry().clear()
+    assert registry_mod._entry_point_info
+    assert registry_mod._entry_point_index
+    clear_entry_point_cache()
+    assert not registry_mod._entry_point_info
+    assert not registry_mod._entry_point_index
+
+
 @pytest.mark.usefixtures('mock_entry_points')
 def test_instance_not_loaded(flask_app, engine):
     """
@@ -336,7 +664,6 @@ def test_repr_state(flask_app, loaded_engine):
     """
     Check that repr(PluginEngineState(...)) is OK
     """
-    from flask_pluginengine.util import get_state
     assert repr(get_state(flask_app)) == ("<_PluginEngineState(<PluginEngine()>, <PluginFlask 'test_engine'>, "
                                           "{'espresso': <EspressoModule(espresso) bound to "
                                           "<PluginFlask 'test_engine'>>})>")
@@ -368,6 +695,85 @@ def test_render_plugin_template(flask_app_ctx, loaded_engine):
         render_plugin_template('test.txt')
 
 
+def test_stream_plugin_template(flask_app_ctx, loaded_engine):
+    """
+    Check that stream_plugin_template works and keeps the plugin context
+    """
+    plugin = loaded_engine.get_plugin('espresso')
+    with plugin.plugin_context():
+        stream = stream_plugin_template('simple_macro.txt')
+        assert ''.join(stream_plugin_template(['missing.txt', 'test.txt'])) == 'plugin test'
+    assert not isinstance(stream, str)
+    assert get_current_plugin() is None
+    # consumed outside the plugin context
+    assert ''.join(stream) == render_template('espresso:simple_macro.txt')
+    assert ''.join(stream_plugin_template('espresso:test.txt')) == 'plugin test'
+    with pytest.raises(RuntimeError, match='stream_plugin_template outside plugin context'):
+        stream_plugin_template('test.txt')
+    # partially consumed streams do not leave the plugin context behind
+    with plugin.plugin_context():
+        stream = stream_plugin_template('simple_macro.txt')
+        assert next(stream)
+    stream.close()
+    del stream
+    assert get_current_plugin() is None
+
+
+def test_stream_plugin_template_plugin_context(flask_app_ctx, loaded_engine):
+    """
+    Check that the plugin context is active whenever the stream is advanced
+    """
+    plugin = loaded_engine.get_plugin('espresso')
+    seen = []
+
+    def _rendered(sender, **kwargs):
+        seen.append(get_current_plugin())
+
+    with template_rendered.connected_to(_rendered, flask_app_ctx):
+        with plugin.plugin_context():
+            stream = stream_plugin_template('test.txt')
+        # the signal is sent by flask after the template has been fully rendered
+        assert ''.join(stream) == 'plugin test'
+    assert seen == [plugin]
+    assert get_current_plugin() is None
+
+
+def test_stream_plugin_template_response(flask_app, loaded_engine):
+    """
+    Check that a plugin template can be streamed as the response of a request
+    """
+    plugin = loaded_engine.get_plugin('espresso', flask_app)
+    bp = PluginBlueprint('espresso', __name__)
+
+    @bp.route('/stream')
+    def stream():
+        # inside a request, flask keeps the request context around while streaming
+        return Response(stream_plugin_template('simple_macro.txt'))
+
+    with plugin.plugin_context():
+        flask_app.register_blueprint(bp)
+    resp = flask_app.test_client().get('/stream')
+    assert resp.status_code == 200
+    data = resp.text
+    with flask_app.app_context():
+        assert data == render_template('espresso:simple_macro.txt')
+    assert get_current_plugin() is None
+
+
+def test_get_current_plugin(flask_app_ctx, loaded_engine):
+    """
+    Check that get_current_plugin returns the actual plugin object
+    """
+    plugin = loaded_engine.get_plugin('espresso')
+    assert get_current_plugin() is None
+    with plugin.plugin_context():
+        assert get_current_plugin() is plugin
+        assert current_plugin._get_current_object() is plugin
+        with plugin_context(None):
+            assert get_current_plugin() is None
+    assert get_current_plugin() is None
+
+
 def _parse_template_data(data):
     items = [re.search(r'(\S+)=(.+)', item.strip()).groups() for item in data.strip().splitlines() if item.strip()]
     rv = dict(items)
@@ -375,6 +781,7 @@ def _parse_template_data(data):
     return rv
 
 
+@pytest.mark.parametrize('flask_app', ('sync', 'async'), indirect=True)
 @pytest.mark.parametrize('in_plugin_ctx', (False, True))
 def test_template_plugin_contexts_macros(flask_app_ctx, loaded_engine, in_plugin_ctx):
     """
@@ -392,6 +799,7 @@ def test_template_plugin_contexts_macros(flask_app_ctx, loaded_engine, in_plugin
         }
 
 
+@pytest.mark.parametrize('flask_app', ('sync', 'async'), indirect=True)
 @pytest.mark.parametrize('in_plugin_ctx', (False, True))
 def test_template_plugin_contexts_macros_extends(flask_app_ctx, loaded_engine, in_plugin_ctx):
     """
@@ -409,6 +817,7 @@ def test_template_plugin_contexts_macros_extends(flask_app_ctx, loaded_engine, i
         }
 
 
+@pytest.mark.parametrize('flask_app', ('sync', 'async'), indirect=True)
 @pytest.mark.parametrize('in_plugin_ctx', (False, True))
 def test_template_plugin_contexts_macros_extends_base(flask_app_ctx, loaded_engine, in_plugin_ctx):
     """
@@ -426,6 +835,7 @@ def test_template_plugin_contexts_macros_extends_base(flask_app_ctx, loaded_engi
         }
 
 
+@pytest.mark.parametrize('flask_app', ('sync', 'async'), indirect=True)
 @pytest.mark.parametrize('in_plugin_ctx', (False, True))
 def test_template_plugin_contexts_macros_nested_calls(flask_app_ctx, loaded_engine, in_plugin_ctx):
     """
@@ -443,6 +853,7 @@ def test_template_plugin_contexts_macros_nested_calls(flask_app_ctx, loaded_engi
         }
 
 
+@pytest.mark.parametrize('flask_app', ('sync', 'async'), indirect=True)
 @pytest.mark.parametrize('in_plugin_ctx', (False, True))
 def test_template_plugin_contexts_super(flask_app_ctx, loaded_engine, in_plugin_ctx):
     """
@@ -458,6 +869,7 @@ def test_template_plugin_contexts_super(flask_app_ctx, loaded_engine, in_plugin_
         }
 
 
+@pytest.mark.parametrize('flask_app', ('sync', 'async'), indirect=True)
 @pytest.mark.parametrize('in_plugin_ctx', (False, True))
 def test_template_plugin_contexts(flask_app_ctx, loaded_engine, in_plugin_ctx):
     """
@@ -499,9 +911,819 @@ def test_template_plugin_contexts(flask_app_ctx, loaded_engine, in_plugin_ctx):
         }
 
 
+@pytest.mark.parametrize('flask_app', ('async',), indirect=True)
+def test_template_plugin_contexts_async_render(flask_app_ctx, loaded_engine):
+    """
+    Check that the plugin context is kept across awaits in concurrently rendered templates
+    """
+    plugin = loaded_engine.get_plugin('espresso')
+
+    async def whereami_async():
+        await asyncio.sleep(0)
+        return current_plugin.name if current_plugin else 'core'
+
+    flask_app_ctx.add_template_global(whereami_async)
+
+    async def _render(name, in_plugin_ctx):
+        with plugin_context(plugin if in_plugin_ctx else None):
+            rv = await flask_app_ctx.jinja_env.get_template(name).render_async()
+            assert get_current_plugin() is (plugin if in_plugin_ctx else None)
+        return _parse_template_data(rv)
+
+    async def _main():
+        renders = [_render(name, in_plugin_ctx)
+                   for name in ('async.txt', 'espresso:async.txt') for in_plugin_ctx in (False, True)] * 10
+        return await asyncio.gather(*renders)
+
+    plugin_data = {'plugin_before': 'espresso', 'plugin_awaited': 'espresso', 'plugin_after': 'espresso'}
+    core_data = {'core_before': 'core', 'core_awaited': 'core', 'core_after': 'core', **plugin_data}
+    assert flask_app_ctx.jinja_env.is_async
+    assert asyncio.run(_main()) == [core_data, core_data, plugin_data, plugin_data] * 10
+
+
+def test_wrap_async_iterator_in_plugin_context(flask_app_ctx, loaded_engine):
+    """
+    Check that async iterators are run inside the plugin context without leaking it
+    """
+    plugin = loaded_engine.get_plugin('espresso')
+
+    async def _gen():
+        for i in range(3):
+            await asyncio.sleep(0)
+            yield i, get_current_plugin()
+
+    async def _main():
+        items = [item async for item in wrap_iterator_in_plugin_context(plugin, _gen())]
+        assert items == [(0, plugin), (1, plugin), (2, plugin)]
+        wrapped = wrap_iterator_in_plugin_context('espresso', _gen)()
+        assert await wrapped.__anext__() == (0, plugin)
+        assert get_current_plugin() is None
+        await wrapped.aclose()
+        with pytest.raises(StopAsyncIteration):
+            await wrapped.__anext__()
+
+    asyncio.run(_main())
+
+
+@pytest.mark.parametrize('flask_app', ('sync', 'async'), indirect=True)
+def test_fragment_cache(flask_app_ctx, loaded_engine):
+    """
+    Check that template fragments are cached per plugin version and vary-key
+    """
+    flask_app_ctx.jinja_env.add_extension(FragmentCacheExtension)
+    plugin = loaded_engine.get_plugin('espresso')
+    calls = []
+    flask_app_ctx.add_template_global(lambda: calls.append(1) or len(calls), 'counter')
+    # caching is opt-in
+    assert get_fragment_cache(flask_app_ctx) is None
+    assert render_template('espresso:cached.txt', key=1) == '1/espresso'
+    assert render_template('espresso:cached.txt', key=1) == '2/espresso'
+    flask_app_ctx.config['PLUGINENGINE_FRAGMENT_CACHE'] = True
+    cache = get_fragment_cache(flask_app_ctx)
+    assert isinstance(cache, LRUFragmentCache)
+    with pytest.raises(TypeError):
+        FragmentCache()
+    assert render_template('espresso:cached.txt', key=1) == '3/espresso'
+    assert render_template('espresso:cached.txt', key=1) == '3/espresso'
+    assert render_template('espresso:cached.txt', key=[1, 2]) == '4/espresso'
+    assert render_template('espresso:cached.txt', key=[1, 2]) == '4/espresso'
+    # rendered in the plugin context even when cached outside of it
+    with plugin_context(plugin):
+        assert render_template('espresso:cached.txt', key=1) == '3/espresso'
+    assert len(cache) == 2
+    # changing the version invalidates the fragments
+    plugin.version = '2.0'
+    assert render_template('espresso:cached.txt', key=1) == '5/espresso'
+    assert len(cache) == 3
+    # so does reloading the plugins
+    get_state(flask_app_ctx).plugins_changed()
+    assert len(cache) == 0
+    assert render_template('espresso:cached.txt', key=1) == '6/espresso'
+
+
+def test_lru_fragment_cache():
+    """
+    Check that the LRU fragment cache evicts the least recently used fragments
+    """
+    cache = LRUFragmentCache(maxsize=2)
+    cache.set('a', 'A')
+    cache.set('b', 'B')
+    assert cache.get('a') == 'A'
+    cache.set('c', 'C')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A'
+    assert cache.get('c') == 'C'
+    assert len(cache) == 2
+    cache.clear()
+    assert cache.get('a') is None
+
+
 def test_template_invalid(flask_app_ctx, loaded_engine):
     """
     Check that loading an invalid plugin template fails
     """
     with pytest.raises(TemplateNotFound):
         render_template('nosuchplugin:foobar.txt')
+
+
+def test_template_change_tracker(tmp_path):
+    """
+    Check that template changes are only picked up when the directory is scanned
+    """
+    path = tmp_path / 'test.txt'
+    path.write_text('old')
+    tracker = TemplateChangeTracker(str(tmp_path), 3600)
+    env = Environment(loader=PrefixIgnoringFileSystemLoader(str(tmp_path), tracker=tracker), auto_reload=True)
+    tpl = env.get_template('espresso:test.txt')
+    assert tpl.render() == 'old'
+    path.write_text('new')
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    # not rescanned yet
+    assert env.get_template('espresso:test.txt') is tpl
+    tracker.scan()
+    assert env.get_template('espresso:test.txt').render() == 'new'
+    path.unlink()
+    tracker.scan()
+    with pytest.raises(TemplateNotFound):
+        env.get_template('espresso:test.txt')
+
+
+def test_template_change_tracker_interval(tmp_path):
+    """
+    Check that the template directory is rescanned once the interval passed
+    """
+    path = tmp_path / 'test.txt'
+    path.write_text('old')
+    tracker = TemplateChangeTracker(str(tmp_path), 0.01)
+    uptodate = tracker.make_uptodate(str(path), os.path.getmtime(path))
+    assert uptodate()
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    time.sleep(0.02)
+    assert not uptodate()
+
+
+def test_template_reload_interval(flask_app, loaded_engine):
+    """
+    Check that the plugin loader uses one tracker per template directory
+    """
+    loader = flask_app.jinja_env.loader.loaders[0]
+    assert loader._get_tracker('/foo') is None
+    flask_app.config['PLUGINENGINE_TEMPLATE_RELOAD_INTERVAL'] = 5
+    tracker = loader._get_tracker('/foo')
+    assert tracker.interval == 5
+    assert loader._get_tracker('/foo') is tracker
+    assert loader._get_tracker('/bar') is not tracker
+
+
+def test_create_plugin_app():
+    """
+    Check that plugin classes can be loaded without entry points
+    """
+    app = create_plugin_app(__name__, {'espresso': EspressoModule, 'otherversion': OtherVersionPlugin},
+                            config={'FOO': 'bar'}, template_folder='templates/core')
+    engine = get_state(app).plugin_engine
+    assert app.config['FOO'] == 'bar'
+    assert app.config['PLUGINENGINE_PLUGINS'] == ['espresso', 'otherversion']
+    assert set(engine.get_active_plugins(app)) == {'espresso', 'otherversion'}
+    assert engine.get_plugin('espresso', app).name == 'espresso'
+    with pytest.raises(RuntimeError):
+        create_plugin_app(__name__, {'cyclea': CycleAPlugin})
+
+
+def test_shared_template_cache(make_plugin_app, plugin_template_cache, monkeypatch):
+    """
+    Check that compiled templates are shared between apps
+    """
+    compiled = []
+    orig_compile = PluginEnvironment.compile
+
+    def _compile(self, source, name=None, *args, **kwargs):
+        compiled.append(name)
+        return orig_compile(self, source, name, *args, **kwargs)
+
+    monkeypatch.setattr(PluginEnvironment, 'compile', _compile)
+    plugin_template_cache.clear()
+    for i in range(3):
+        app = make_plugin_app(__name__, {'espresso': EspressoModule}, template_folder='templates/core')
+        assert isinstance(app.jinja_env.bytecode_cache, MemoryBytecodeCache)
+        with app.app_context():
+            assert render_template('test.txt') == 'core test'
+    assert compiled == ['test.txt']
+
+
+def test_shared_templates(monkeypatch):
+    """
+    Check that apps can share the plugin template loader and compiled templates
+    """
+    compiled = []
+    orig_compile = PluginEnvironment.compile
+
+    def _compile(self, source, name=None, *args, **kwargs):
+        compiled.append(name)
+        return orig_compile(self, source, name, *args, **kwargs)
+
+    def init_loader(self, *args, **kwargs):
+        super(PrefixIgnoringFileSystemLoader, self).__init__(os.path.join(os.path.dirname(__file__),
+                                                                          'templates/plugin'))
+
+    monkeypatch.setattr(PluginEnvironment, 'compile', _compile)
+    monkeypatch.setattr('flask_pluginengine.templating.PrefixIgnoringFileSystemLoader.__init__', init_loader)
+    shared_template_cache.clear()
+    apps = [create_plugin_app(__name__, {'espresso': EspressoModule}, config={'PLUGINENGINE_SHARE_TEMPLATES': True},
+                              template_folder='templates/core')
+            for __ in range(2)]
+    loaders = [app.jinja_env.loader.loaders[0] for app in apps]
+    assert loaders[0] is loaders[1]
+    assert loaders[0].app is None
+    for app in apps:
+        assert app.jinja_env.bytecode_cache is shared_template_cache
+        plugin = get_state(app).plugin_engine.get_plugin('espresso', app)
+        app.add_template_global(lambda: current_plugin.name if current_plugin else 'core', 'whereami')
+        with app.app_context():
+            assert _parse_template_data(render_template('espresso:simple_macro.txt')) == {
+                'macro': 'core-imp-macro/core/undef',
+                'macro_call': 'core-imp-macro/core/espresso'
+            }
+            with plugin.plugin_context():
+                assert render_plugin_template('test.txt') == 'plugin test'
+    assert sorted(compiled) == ['espresso:simple_macro.txt', 'espresso:test.txt', 'macro.txt']
+    # not shared by default
+    app = create_plugin_app(__name__, {'espresso': EspressoModule}, template_folder='templates/core')
+    assert app.jinja_env.loader.loaders[0].app is app
+    assert app.jinja_env.bytecode_cache is None
+
+
+def test_plugin_static_files(tmp_path):
+    """
+    Check that plugin static files are fingerprinted and served precompressed
+    """
+    static = tmp_path / 'static'
+    (static / 'js').mkdir(parents=True)
+    (static / 'js' / 'app.js').write_text('console.log("app");')
+    (static / 'js' / 'app.js.br').write_bytes(b'brotli')
+    (static / 'js' / 'app.js.gz').write_bytes(b'gzip')
+    (static / 'style.css').write_text('body {}')
+    (static / 'orphan.js.gz').write_bytes(b'orphan')
+    blueprint = PluginBlueprint('static_test', __name__, root_path=str(tmp_path))
+    app = create_plugin_app(__name__, {'espresso': EspressoModule})
+    with app.app_context(), get_state(app).plugins['espresso'].plugin_context():
+        app.register_blueprint(blueprint)
+    manifest = blueprint.static_manifest
+    assert set(manifest) == {'js/app.js', 'style.css'}
+    assert manifest['style.css'] == hashlib.sha256(b'body {}').hexdigest()[:12]
+    with app.test_request_context():
+        url = url_for_plugin_static('static_test', 'js/app.js')
+        assert url == f'/static/plugins/static_test/js/app.js?v={manifest["js/app.js"]}'
+        assert url_for_plugin_static('static_test', 'missing.js') == '/static/plugins/static_test/missing.js'
+
+    client = app.test_client()
+    resp = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+    assert resp.data == b'brotli'
+    assert resp.content_encoding == 'br'
+    assert resp.mimetype in {'application/javascript', 'text/javascript'}
+    assert 'Accept-Encoding' in resp.vary
+    assert resp.cache_control.immutable
+    assert resp.cache_control.max_age == 365 * 24 * 3600
+    resp = client.get(url, headers={'Accept-Encoding': 'gzip, br;q=0.5'})
+    assert resp.data == b'gzip'
+    assert resp.content_encoding == 'gzip'
+    resp = client.get('/static/plugins/static_test/js/app.js?v=outdated')
+    assert resp.data == b'console.log("app");'
+    assert resp.content_encoding is None
+    assert not resp.cache_control.immutable
+    assert resp.cache_control.max_age != 365 * 24 * 3600
+    resp = client.get('/static/plugins/static_test/style.css', headers={'Accept-Encoding': 'gzip, br'})
+    assert resp.data == b'body {}'
+    assert 'Accept-Encoding' not in resp.vary
+    assert client.get('/static/plugins/static_test/orphan.js', headers={'Accept-Encoding': 'gzip'}).status_code == 404
+
+
+def test_dependency_graph():
+    """
+    Check that the dependency graph of the active plugins is correct
+    """
+    @depends('a')
+    class B(Plugin):
+        pass
+
+    @depends('b')
+    @uses('a', 'missing')
+    class C(Plugin):
+        pass
+
+    @uses('c')
+    class D(Plugin):
+        pass
+
+    app = create_plugin_app(__name__, {'d': D, 'c': C, 'b': B, 'a': EspressoModule, 'x': OtherVersionPlugin})
+    graph = get_state(app).plugin_engine.get_dependency_graph(app)
+    assert set(graph) == {'a', 'b', 'c', 'd', 'x'}
+    assert graph.requires('c') == {'b'}
+    assert graph.uses('c') == {'a'}
+    assert graph.dependencies('c') == {'a', 'b'}
+    assert graph.dependents('a') == {'b', 'c'}
+    assert graph.all_dependencies('d') == {'a', 'b', 'c'}
+    assert graph.all_dependents('a') == {'b', 'c', 'd'}
+    assert graph.all_dependents('x') == set()
+    assert [set(level) for level in graph.levels] == [{'a', 'x'}, {'b'}, {'c'}, {'d'}]
+    assert graph.level('c') == 2
+    data = graph.to_dict()
+    assert {'from': 'c', 'to': 'a', 'hard': False} in data['edges']
+    assert {'from': 'c', 'to': 'b', 'hard': True} in data['edges']
+    assert len(data['edges']) == 4
+    dot = graph.to_dot()
+    assert '"c" -> "a" [style=dashed];' in dot
+    assert '"c" -> "b";' in dot
+
+
+def test_dependency_graph_soft_cycle():
+    """
+    Check that plugins with circular soft dependencies share a level
+    """
+    @uses('f')
+    class E(Plugin):
+        pass
+
+    @uses('e')
+    class F(Plugin):
+        pass
+
+    @depends('e')
+    class G(Plugin):
+        pass
+
+    app = create_plugin_app(__name__, {'e': E, 'f': F, 'g': G})
+    graph = get_state(app).plugin_engine.get_dependency_graph(app)
+    assert [set(level) for level in graph.levels] == [{'e', 'f'}, {'g'}]
+    assert graph.level('e') == graph.level('f') == 0
+    assert graph.uses('e') == {'f'}
+
+
+def test_plugin_for_endpoint(flask_app, loaded_engine):
+    """
+    Check that the plugin owning an endpoint or blueprint can be looked up
+    """
+    plugin = loaded_engine.get_plugin('espresso', flask_app)
+    bp = PluginBlueprint('espresso', __name__)
+    seen = {}
+
+    @bp.route('/espresso')
+    def espresso():
+        seen['plugin'] = loaded_engine.get_plugin_for_endpoint(request.endpoint)
+        return 'coffee'
+
+    with plugin.plugin_context():
+        flask_app.register_blueprint(bp)
+        flask_app.register_blueprint(bp, name='ristretto', url_prefix='/ristretto')
+
+    with flask_app.app_context():
+        assert loaded_engine.get_plugin_for_endpoint('plugin_espresso.espresso') is plugin
+        assert loaded_engine.get_plugin_for_endpoint('ristretto.espresso') is plugin
+        assert loaded_engine.get_plugin_for_endpoint('static') is None
+        assert loaded_engine.get_plugin_for_blueprint('plugin_espresso') is plugin
+        assert loaded_engine.get_plugin_for_blueprint('ristretto') is plugin
+        assert loaded_engine.get_plugin_for_blueprint('other') is None
+    assert flask_app.test_client().get('/ristretto/espresso').text == 'coffee'
+    assert seen['plugin'] is plugin
+
+
+def test_plugin_url_rules():
+    """
+    Check that plugin URL rules are available immediately and build their URLs lazily
+    """
+    built_urls = []
+
+    class RoutesPlugin(Plugin):
+        """Routes"""
+
+        def init(self):
+            bp = PluginBlueprint(self.name, __name__)
+            bp.add_url_rule('/<int:id>', 'item', lambda id: str(id))
+            bp.add_url_rule('/item/<name>', 'named', lambda name: name, defaults={'name': 'default'})
+            self.app.register_blueprint(bp, url_prefix=f'/{self.name}')
+            with self.app.test_request_context():
+                built_urls.append(url_for(f'plugin_{self.name}.item', id=1))
+
+    app = create_plugin_app(__name__, {'a': RoutesPlugin, 'b': type('RoutesPluginB', (RoutesPlugin,), {})})
+    app.add_url_rule('/core', 'core', lambda: 'core')
+    engine = get_state(app).plugin_engine
+    assert sorted(built_urls) == ['/a/1', '/b/1']
+    rule_classes = {rule.endpoint: type(rule) for rule in app.url_map.iter_rules()}
+    assert rule_classes.pop('core') is Rule
+    assert rule_classes.pop('static') is Rule
+    assert set(rule_classes.values()) == {LazyBuilderRule}
+    assert engine.get_plugin_endpoints('a', app) == {'plugin_a.item', 'plugin_a.named', 'plugin_a.static'}
+    assert engine.get_plugin_endpoints('b', app) == {'plugin_b.item', 'plugin_b.named', 'plugin_b.static'}
+    assert engine.get_plugin_endpoints('missing', app) == set()
+    with app.test_request_context():
+        assert url_for('plugin_a.item', id=123) == '/a/123'
+        assert url_for('plugin_a.item', id=1, x='y') == '/a/1?x=y'
+        assert url_for('plugin_b.named') == '/b/item/default'
+        assert url_for('core') == '/core'
+    client = app.test_client()
+    assert client.get('/b/42').text == '42'
+    assert client.get('/core').text == 'core'
+
+
+def test_custom_url_rule_class():
+    """
+    Check that the rule class of non-plugin rules can still be customized
+    """
+    class CustomRule(Rule):
+        pass
+
+    class CustomRuleFlask(PluginFlask):
+        url_rule_class = CustomRule
+
+    class RoutesPlugin(Plugin):
+        """Routes"""
+
+        def init(self):
+            bp = PluginBlueprint(self.name, __name__)
+            bp.add_url_rule('/item', 'item', lambda: 'item')
+            self.app.register_blueprint(bp, url_prefix=f'/{self.name}')
+
+    app = create_plugin_app(__name__, {'routes': RoutesPlugin}, app_class=CustomRuleFlask)
+    app.add_url_rule('/core', 'core', lambda: 'core')
+    assert app.url_rule_class is CustomRule
+    rule_classes = {rule.endpoint: type(rule) for rule in app.url_map.iter_rules()}
+    assert rule_classes['core'] is CustomRule
+    assert rule_classes['plugin_routes.item'] is LazyBuilderRule
+    app = PluginFlask(__name__)
+    app.url_rule_class = CustomRule
+    app.add_url_rule('/core', 'core', lambda: 'core')
+    assert {type(rule) for rule in app.url_map.iter_rules('core')} == {CustomRule}
+    assert PluginFlask(__name__).url_rule_class is Rule
+
+
+def test_active_plugins_snapshot(flask_app, loaded_engine):
+    """
+    Check that the active plugins are only copied when they change
+    """
+    with flask_app.app_context():
+        active = loaded_engine.get_active_plugins()
+        assert loaded_engine.get_active_plugins() is active
+        assert loaded_engine.get_failed_plugins() is loaded_engine.get_failed_plugins()
+        assert loaded_engine.get_failure_report() is loaded_engine.get_failure_report()
+        assert list(loaded_engine.iter_active_plugins()) == [active['espresso']]
+        state = get_state(flask_app)
+        del state.plugins['espresso']
+        assert loaded_engine.get_active_plugins() is active
+        state.plugins_changed()
+        assert loaded_engine.get_active_plugins() == {}
+        assert list(loaded_engine.iter_active_plugins()) == []
+
+
+def test_hooks():
+    """
+    Check that hooks are called in dependency order and in the plugin context
+    """
+    class HookA(Plugin):
+        @hook
+        def menu_items(self, prefix):
+            return f'{prefix}{get_current_plugin().name}'
+
+        @hook('find')
+        def find_a(self, key):
+            return None
+
+    @depends('a')
+    class HookB(HookA):
+        @hook('find')
+        def find_b(self, key):
+            return f'b:{key}'
+
+        def menu_items(self, prefix):
+            pass
+
+    @uses('b')
+    class HookC(HookA):
+        pass
+
+    app = create_plugin_app(__name__, {'c': HookC, 'b': HookB, 'a': HookA, 'x': EspressoModule})
+    engine = get_state(app).plugin_engine
+    with app.app_context():
+        assert engine.call_hook('menu_items', '-') == ['-a', '-c']
+        assert engine.call_hook('find', 'k') == [None, None, 'b:k', None]
+        assert engine.call_hook_first('find', key='k') == 'b:k'
+        assert engine.call_hook_first('menu_items', prefix='') == 'a'
+        assert engine.call_hook_first('nothing') is None
+        assert engine.call_hook('nothing') == []
+        plugins = engine.get_active_plugins()
+        assert engine.get_hook_implementations('find') == (plugins['a'], plugins['b'], plugins['b'], plugins['c'])
+        assert engine.get_hook_implementations('nothing') == ()
+        assert not get_current_plugin()
+
+
+def test_budgets():
+    """
+    Check that plugin budgets are enforced
+    """
+    signal = Namespace().signal('test-budget')
+    calls = []
+    kept = []
+
+    class BudgetPlugin(Plugin):
+        budget = PluginBudget(time=0, max_violations=2)
+
+        def init(self):
+            self.connect(signal, self._receiver)
+
+        def _receiver(self, sender):
+            calls.append(get_current_plugin())
+
+        @hook
+        def allocate(self):
+            kept.append(list(range(10000)))
+            return True
+
+    app = create_plugin_app(__name__, {'budget': BudgetPlugin, 'espresso': EspressoModule},
+                            config={'PLUGINENGINE_BUDGETS': {'espresso': PluginBudget(memory=1000)}})
+    engine = get_state(app).plugin_engine
+    plugin = engine.get_plugin('budget', app)
+    assert engine.get_plugin('espresso', app).budget.memory == 1000
+    with app.app_context():
+        for i in range(3):
+            signal.send()
+        assert calls == [plugin, plugin]
+        assert engine.call_hook('allocate') == [None]
+        assert engine.get_budget_violations() == {'budget': {'time': 2}}
+    with app.app_context():
+        signal.send()
+        assert calls == [plugin, plugin, plugin]
+        assert engine.get_budget_violations() == {'budget': {'time': 3}}
+
+    plugin.budget = PluginBudget(memory=1000, max_violations=1)
+    tracemalloc.start()
+    try:
+        with app.app_context():
+            assert engine.call_hook('allocate') == [True]
+            # memory budget violations do not disable the plugin
+            assert engine.call_hook('allocate') == [True]
+    finally:
+        tracemalloc.stop()
+    assert engine.get_budget_violations(app) == {'budget': {'time': 3, 'memory': 2}}
+
+    # receivers of budgeted plugins can be disconnected using the regular wrapper
+    assert len(signal.receivers) == 1
+    signal.disconnect(wrap_in_plugin_context(plugin, plugin._receiver))
+    assert not signal.receivers
+
+
+def test_profiler(flask_app, loaded_engine):
+    """
+    Check that the profiler attributes samples to the active plugin
+    """
+    plugin = loaded_engine.get_plugin('espresso', flask_app)
+    # plugins are only recorded per thread while a profiler is running
+    with flask_app.app_context(), plugin.plugin_context():
+        assert _plugin_ctx_stack.thread_plugins == {}
+    # sample manually instead of waiting for the profiler's own samples
+    profiler = PluginProfiler(interval=60)
+    profiler.start()
+    ready = threading.Event()
+    done = threading.Event()
+
+    def _busy():
+        ready.set()
+        done.wait(5)
+
+    def _worker():
+        with flask_app.app_context():
+            with_plugin_context(plugin)(_busy)()
+
+    thread = threading.Thread(target=_worker)
+    thread.start()
+    try:
+        assert ready.wait(5)
+        for i in range(3):
+            profiler.sample()
+    finally:
+        done.set()
+        thread.join()
+        profiler.stop()
+    assert _plugin_ctx_stack.thread_plugins == {}
+    assert profiler.get_stats()['espresso'] == 3
+    assert profiler.get_stats()[None] >= 3  # at least the test itself
+    collapsed = profiler.export_collapsed().splitlines()
+    line = next(line for line in collapsed if line.startswith('plugin:espresso;'))
+    assert ';test_engine:_worker;' in line
+    assert ';test_engine:_busy;' in line
+    assert line.endswith(' 3')
+    profiler.reset()
+    assert profiler.get_stats() == {}
+
+
+@pytest.mark.parametrize('in_plugin_ctx', (True, False))
+def test_profiler_plugin_context(flask_app, loaded_engine, in_plugin_ctx):
+    """
+    Check that the profiler attributes samples to the plugin of a plugin context block
+    """
+    plugin = loaded_engine.get_plugin('espresso', flask_app)
+    profiler = PluginProfiler(interval=60)
+    profiler.start()
+    ready = threading.Event()
+    done = threading.Event()
+
+    def _worker():
+        with flask_app.app_context(), plugin_context(plugin):
+            with plugin_context(plugin if in_plugin_ctx else None):
+                ready.set()
+                done.wait(5)
+
+    thread = threading.Thread(target=_worker)
+    thread.start()
+    try:
+        assert ready.wait(5)
+        for i in range(5):
+            profiler.sample(exclude=(threading.get_ident(),))
+    finally:
+        done.set()
+        thread.join()
+    assert profiler.get_stats().get('espresso', 0) == (5 if in_plugin_ctx else 0)
+    profiler.reset()
+    profiler.sample(exclude=(threading.get_ident(),))
+    profiler.stop()
+    assert 'espresso' not in profiler.get_stats()
+
+
+def test_profiler_engine(loaded_engine):
+    """
+    Check that the engine can start and stop the profiler
+    """
+    profiler = loaded_engine.start_profiler(interval=0.001)
+    assert profiler.running
+    with pytest.raises(RuntimeError):
+        loaded_engine.start_profiler()
+    time.sleep(0.01)
+    assert loaded_engine.stop_profiler() is profiler
+    assert not profiler.running
+    assert profiler.get_stats()[None] > 0
+    with pytest.raises(RuntimeError):
+        loaded_engine.stop_profiler()
+
+
+def test_import_audit(flask_app, engine, tmp_path, monkeypatch):
+    """
+    Check that the modules imported by a plugin are recorded
+    """
+    from flask_pluginengine import registry as registry_mod
+
+    pkg = tmp_path / 'audit_plugin_pkg'
+    pkg.mkdir()
+    (pkg / '__init__.py').write_text('from . import heavy\n'
+                                     'from flask_pluginengine import Plugin\n'
+                                     'class AuditPlugin(Plugin):\n'
+                                     '    """Audit"""\n')
+    (pkg / 'heavy.py').write_text('DATA = [str(i) for i in range(10000)]\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    entry_point = EntryPoint('audit', 'audit_plugin_pkg:AuditPlugin', 'test')._for(MockDistribution('1.0'))
+    monkeypatch.setattr(registry_mod, 'importlib_entry_points', lambda *, group: [entry_point])
+    monkeypatch.setattr(registry_mod, '_entry_point_index', {})
+    flask_app.config['PLUGINENGINE_PLUGINS'] = ['audit']
+    flask_app.config['PLUGINENGINE_AUDIT_IMPORTS'] = True
+    try:
+        assert engine.load_plugins(flask_app)
+    finally:
+        sys.modules.pop('audit_plugin_pkg', None)
+        sys.modules.pop('audit_plugin_pkg.heavy', None)
+    assert not tracemalloc.is_tracing()
+    report = engine.get_import_report(flask_app)['audit']
+    modules = {module.name: module for module in report.modules}
+    assert list(modules) == ['audit_plugin_pkg.heavy', 'audit_plugin_pkg']
+    heavy = modules['audit_plugin_pkg.heavy']
+    pkg_module = modules['audit_plugin_pkg']
+    assert pkg_module.cumulative_time >= heavy.cumulative_time
+    assert pkg_module.self_time == pytest.approx(pkg_module.cumulative_time - heavy.cumulative_time)
+    assert heavy.memory > 100000
+    assert report.memory >= heavy.memory
+    assert report.elapsed >= pkg_module.cumulative_time
+    assert json.loads(json.dumps(report.to_dict()))['modules'][0]['name'] == 'audit_plugin_pkg.heavy'
+    assert engine.get_plugin('audit', flask_app).__module__ == 'audit_plugin_pkg'
+    assert type(sys.modules.get('json').__loader__).__name__ != '_TimingLoader'
+
+
+class MemoryHungryPlugin(Plugin):
+    """Memory hungry"""
+
+    def init(self):
+        self.data = [str(i) for i in range(20000)]
+
+
+def test_memory_report():
+    """
+    Check that the memory used by plugins is tracked
+    """
+    app = create_plugin_app(__name__, {'hungry': MemoryHungryPlugin, 'espresso': EspressoModule},
+                            config={'PLUGINENGINE_TRACK_MEMORY': True})
+    engine = get_state(app).plugin_engine
+    assert not tracemalloc.is_tracing()
+    report = engine.get_memory_report(app)
+    assert set(report) == {'hungry', 'espresso'}
+    assert report['hungry'].import_memory is None
+    assert report['hungry'].init_memory > 1000000
+    assert report['hungry'].total == report['hungry'].init_memory
+    assert report['espresso'].init_memory < 100000
+    hungry_size = engine.estimate_plugin_size('hungry', app)
+    assert hungry_size > 1000000
+    # neither the app nor the other plugins are included
+    assert engine.estimate_plugin_size('espresso', app) < 10000
+
+    result = app.test_cli_runner().invoke(args=['pluginengine', 'memory', '--estimate', '--json'])
+    assert result.exit_code == 0, result.output
+    rows = json.loads(result.output)
+    assert [row['name'] for row in rows] == ['hungry', 'espresso']
+    assert rows[0]['init'] == report['hungry'].init_memory
+    assert rows[0]['size'] > 1000000
+    result = app.test_cli_runner().invoke(args=['pluginengine', 'memory'])
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines()[0].split() == ['name', 'import', 'init', 'total']
+    assert result.output.splitlines()[1].startswith('hungry ')
+
+
+def test_memory_report_disabled(flask_app, loaded_engine):
+    """
+    Check that memory is only tracked if enabled
+    """
+    assert loaded_engine.get_memory_report(flask_app) == {}
+    result = flask_app.test_cli_runner().invoke(args=['pluginengine', 'memory'])
+    assert result.exit_code == 0
+    assert 'Memory tracking is disabled' in result.output
+    assert 'espresso' in result.output
+
+
+def test_memory_report_import(flask_app, engine, mock_entry_points):
+    """
+    Check that the memory allocated while importing plugins is tracked
+    """
+    flask_app.config['PLUGINENGINE_TRACK_MEMORY'] = True
+    flask_app.config['PLUGINENGINE_PLUGINS'] = ['espresso', 'importfail']
+    engine.load_plugins(flask_app)
+    report = engine.get_memory_report(flask_app)
+    assert set(report) == {'espresso'}
+    assert report['espresso'].import_memory is not None
+    assert report['espresso'].init_memory is not None
+
+
+def test_lazy_imports():
+    """
+    Check that the package only imports the submodules that are used
+    """
+    import flask_pluginengine
+    for name in flask_pluginengine.__all__:
+        assert getattr(flask_pluginengine, name) is not None
+    assert set(flask_pluginengine.__all__) <= set(dir(flask_pluginengine))
+    with pytest.raises(AttributeError):
+        flask_pluginengine.does_not_exist
+    code = ('import sys\n'
+            'from flask_pluginengine import Plugin, current_plugin\n'
+            'print(" ".join(sorted(m for m in sys.modules if m.startswith("flask_pluginengine."))))\n'
+            'print("importlib_metadata" in sys.modules)')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    modules, metadata_imported = output.splitlines()
+    assert 'flask_pluginengine.plugin' in modules.split()
+    assert 'flask_pluginengine.engine' not in modules.split()
+    assert 'flask_pluginengine.templating' not in modules.split()
+    assert metadata_imported == 'False'
+    # submodules are still available as attributes of the package
+    code = ('import flask_pluginengine\n'
+            'print(flask_pluginengine.util.__name__, flask_pluginengine.engine.PluginEngine.__name__)')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert output.split() == ['flask_pluginengine.util', 'PluginEngine']
+
+
+def test_wrapped_function(flask_app, loaded_engine):
+    """
+    Check that functions wrapped in a plugin context behave like the original function
+    """
+    plugin = loaded_engine.get_plugin('espresso', flask_app)
+
+    def func(value):
+        """Docstring"""
+        return current_plugin.name, value
+
+    func.custom = 'test'
+    wrapped = with_plugin_context(plugin)(func)
+    assert '__dict__' not in vars(type(wrapped))
+    assert wrapped.__name__ == 'func'
+    assert wrapped.__qualname__ == func.__qualname__
+    assert wrapped.__doc__ == 'Docstring'
+    assert wrapped.__wrapped__ is func
+    assert wrapped.custom == 'test'
+    assert wrapped is with_plugin_context(plugin)(func)
+
+    class Foo:
+        method = wrapped
+
+    foo = Foo()
+    with flask_app.app_context():
+        assert wrapped(1) == ('espresso', 1)
+        assert foo.method() == ('espresso', foo)
+        copied = copy.copy(wrapped)
+        assert copied is not wrapped
+        assert copied(2) == ('espresso', 2)
+        assert copied.custom == 'test'
+    assert Foo.method is wrapped
+    assert not hasattr(get_state(flask_app), '__dict__')